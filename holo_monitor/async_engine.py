@@ -0,0 +1,222 @@
+from __future__ import annotations
+import asyncio
+import json as _json
+import threading
+from http.cookiejar import CookieJar
+from typing import Any, Dict, Iterable, List, Tuple
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Optional asyncio fetch engine.
+#
+# One event loop runs on a daemon thread and owns a single async HTTP client
+# (httpx if installed, otherwise aiohttp). AsyncSession exposes the subset of
+# the requests.Session API the pipeline uses (get/head/post returning
+# response-like objects), so fetch_html, detail scrapers, image mirroring and
+# webhooks all multiplex over the same loop and connection pool. Callers that
+# have many URLs at once can use AsyncSession.gather to issue them in one
+# batch without a thread per request (runner prefetches every monitor page
+# this way).
+#
+# Cookies live in the fallback requests session's jar, which the engine reads
+# and updates too, so warm-up cookies are seen by both clients.
+
+
+def available_backend() -> str:
+    try:
+        import httpx  # type: ignore  # noqa: F401
+        return 'httpx'
+    except Exception:
+        pass
+    try:
+        import aiohttp  # type: ignore  # noqa: F401
+        return 'aiohttp'
+    except Exception:
+        pass
+    return ''
+
+
+class EngineResponse:
+    """Minimal stand-in for requests.Response."""
+
+    def __init__(self, url: str, status_code: int, headers: Any, content: bytes, encoding: str | None):
+        self.url = url
+        self.status_code = int(status_code)
+        self.headers = CaseInsensitiveDict(dict(headers or {}))
+        self.content = content or b''
+        self.encoding = encoding
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self) -> Any:
+        return _json.loads(self.text)
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=None)
+
+    def close(self) -> None:
+        pass
+
+
+class AsyncEngine:
+    def __init__(self, backend: str, pool_size: int = 10, total_connections: int = 100,
+                 cookies: CookieJar | None = None):
+        if backend not in ('httpx', 'aiohttp'):
+            raise RuntimeError('async engine requires httpx or aiohttp to be installed')
+        self.backend = backend
+        self.cookies = cookies if cookies is not None else requests.cookies.RequestsCookieJar()
+        self.pool_size = max(1, int(pool_size))
+        self.total_connections = max(self.pool_size, int(total_connections))
+        self._client: Any = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='holo-async-engine', daemon=True)
+        self._thread.start()
+
+    # ---- client lifecycle (always on the loop thread) ----
+    async def _get_client(self) -> Any:
+        if self._client is None:
+            if self.backend == 'httpx':
+                import httpx  # type: ignore
+                limits = httpx.Limits(max_connections=self.total_connections, max_keepalive_connections=self.pool_size)
+                # httpx reads and stores cookies straight in the shared jar
+                self._client = httpx.AsyncClient(limits=limits, cookies=self.cookies,
+                                                 transport=httpx.AsyncHTTPTransport(retries=2, limits=limits))
+            else:
+                import aiohttp  # type: ignore
+                connector = aiohttp.TCPConnector(limit=self.total_connections, limit_per_host=self.pool_size)
+                # aiohttp needs its own jar type; cookies are synced by hand in request_async
+                self._client = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+        return self._client
+
+    async def request_async(self, method: str, url: str, *, headers: Dict[str, str] | None = None,
+                            timeout: float | None = 30, allow_redirects: bool = True, json: Any = None,
+                            data: Any = None, auth: Tuple[str, str] | None = None,
+                            params: Any = None) -> EngineResponse:
+        client = await self._get_client()
+        if self.backend == 'httpx':
+            body_kw: Dict[str, Any] = {'content': data} if isinstance(data, (bytes, str)) else {'data': data}
+            resp = await client.request(method, url, headers=headers, params=params, json=json, auth=auth,
+                                        follow_redirects=allow_redirects, timeout=timeout, **body_kw)
+            return EngineResponse(str(resp.url), resp.status_code, resp.headers, resp.content, resp.encoding)
+        import aiohttp  # type: ignore
+        basic = aiohttp.BasicAuth(*auth) if auth else None
+        headers = dict(headers or {})
+        cookie = requests.cookies.get_cookie_header(self.cookies, requests.Request(method, url, params=params).prepare())
+        if cookie:
+            headers['Cookie'] = cookie
+        async with client.request(method, url, headers=headers, params=params, json=json, data=data, auth=basic,
+                                  allow_redirects=allow_redirects,
+                                  timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            for hop in list(resp.history) + [resp]:
+                for name, morsel in hop.cookies.items():
+                    self.cookies.set(name, morsel.value, domain=morsel['domain'] or hop.url.host,
+                                     path=morsel['path'] or '/')
+            body = await resp.read()
+            try:
+                encoding = resp.get_encoding()
+            except Exception:
+                encoding = None
+            return EngineResponse(str(resp.url), resp.status, resp.headers, body, encoding)
+
+    # ---- sync facade ----
+    def request(self, method: str, url: str, **kwargs: Any) -> EngineResponse:
+        fut = asyncio.run_coroutine_threadsafe(self.request_async(method, url, **kwargs), self._loop)
+        return fut.result()
+
+    def gather(self, calls: Iterable[Tuple[str, str, Dict[str, Any]]]) -> List[EngineResponse | BaseException]:
+        """Run (method, url, kwargs) calls concurrently on the loop; exceptions are returned in place."""
+        async def _run() -> List[Any]:
+            return await asyncio.gather(
+                *(self.request_async(m, u, **(kw or {})) for m, u, kw in calls),
+                return_exceptions=True,
+            )
+        return asyncio.run_coroutine_threadsafe(_run(), self._loop).result()
+
+    def close(self) -> None:
+        async def _close() -> None:
+            if self._client is not None:
+                if self.backend == 'httpx':
+                    await self._client.aclose()
+                else:
+                    await self._client.close()
+                self._client = None
+        try:
+            asyncio.run_coroutine_threadsafe(_close(), self._loop).result(timeout=10)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+_ENGINE_KWARGS = frozenset({'headers', 'params', 'timeout', 'allow_redirects', 'json', 'data', 'auth'})
+_SUPPORTED_KWARGS = _ENGINE_KWARGS | {'files', 'stream'}
+
+
+class AsyncSession:
+    """requests.Session-compatible facade over an AsyncEngine.
+
+    Multipart uploads (`files=`), file-like bodies and `stream=True` are not
+    routed through the engine; they fall back to the regular pooled requests
+    session, which shares the engine's cookie jar. Keyword arguments outside
+    the supported subset raise TypeError instead of being dropped.
+    """
+
+    def __init__(self, engine: AsyncEngine, fallback: requests.Session):
+        self.engine = engine
+        self.fallback = fallback
+        self.headers: Dict[str, str] = {}
+
+    def _engine_kwargs(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        headers = dict(self.headers)
+        headers.update(kwargs.get('headers') or {})
+        return {
+            'headers': headers,
+            'params': kwargs.get('params'),
+            'timeout': kwargs.get('timeout', 30),
+            'allow_redirects': kwargs.get('allow_redirects', True),
+            'json': kwargs.get('json'),
+            'data': kwargs.get('data'),
+            'auth': kwargs.get('auth'),
+        }
+
+    def request(self, method: str, url: str, **kwargs: Any) -> Any:
+        unsupported = set(kwargs) - _SUPPORTED_KWARGS
+        if unsupported:
+            raise TypeError(f"AsyncSession does not support: {', '.join(sorted(unsupported))}")
+        data = kwargs.get('data')
+        streaming_body = data is not None and not isinstance(data, (bytes, str, dict))
+        if kwargs.get('files') is not None or kwargs.get('stream') or streaming_body:
+            return self.fallback.request(method, url, **kwargs)
+        return self.engine.request(method.upper(), url, **self._engine_kwargs(kwargs))
+
+    def gather(self, calls: Iterable[Tuple[str, str, Dict[str, Any]]]) -> List[Any]:
+        """Issue (method, url, kwargs) calls concurrently on the loop; exceptions are returned in place."""
+        batch = []
+        for method, url, kwargs in calls:
+            kwargs = kwargs or {}
+            unsupported = set(kwargs) - _ENGINE_KWARGS
+            if unsupported:
+                raise TypeError(f"AsyncSession.gather does not support: {', '.join(sorted(unsupported))}")
+            batch.append((method.upper(), url, self._engine_kwargs(kwargs)))
+        return self.engine.gather(batch)
+
+    def get(self, url: str, **kwargs: Any) -> Any:
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url: str, **kwargs: Any) -> Any:
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> Any:
+        return self.request('POST', url, **kwargs)
+
+    def close(self) -> None:
+        self.engine.close()
+        self.fallback.close()
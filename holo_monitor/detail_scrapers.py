@@ -8,6 +8,7 @@ from urllib.parse import urlparse
 from bs4 import BeautifulSoup
 
 from .runner import fetch_html
+from .parsing import make_soup
 from .scrape_utils import g, text_with_breaks, best_from_srcset, abs_url, no_query, uniq, normalize_release_date_jp, normalize_release_date
 
 
@@ -44,7 +45,7 @@ def _body_source(entries):
 
 
 def scrape_amiami(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'BodySource': '', 'Images': [],
         'Maker': '', 'Materials': '', 'Modeler': '', 'PriceValue': '',
@@ -196,7 +197,7 @@ def scrape_amiami(url: str, html: str) -> Dict[str, Any]:
 
 
 def scrape_kotobukiya(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'BodySource': '', 'Images': [],
         'Maker': '', 'Materials': '', 'Modeler': '', 'PriceValue': '',
@@ -282,7 +283,7 @@ def scrape_kotobukiya(url: str, html: str) -> Dict[str, Any]:
 
 
 def scrape_palverse(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'BodySource': '', 'Images': [],
         'Maker': '', 'Materials': '', 'Modeler': '', 'PriceValue': '',
@@ -343,7 +344,7 @@ def scrape_palverse(url: str, html: str) -> Dict[str, Any]:
     return out
 
 def scrape_bandai_candy(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'BodySource': '', 'Images': [],
         'PriceValue': '', 'PriceCurrency': '', 'PriceTaxIncluded': '', 'JAN': '',
@@ -432,7 +433,7 @@ def scrape_bandai_candy(url: str, html: str) -> Dict[str, Any]:
     return out
 
 def scrape_goodsmile(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'BodySource': '', 'Images': [],
         'Maker': '', 'Materials': '', 'Modeler': '', 'PriceValue': '',
@@ -526,7 +527,7 @@ def scrape_goodsmile(url: str, html: str) -> Dict[str, Any]:
 
     return out
 def scrape_hololive(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'BodySource': '', 'Images': [],
         'Maker': '', 'Materials': '', 'Modeler': '', 'PriceValue': '',
@@ -678,7 +679,7 @@ def scrape_hololive(url: str, html: str) -> Dict[str, Any]:
 
 
 def scrape_amazon(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'Images': [], 'PriceValue': '',
         'PriceCurrency': '', 'PriceTaxIncluded': '', 'ReleaseDate': '',
@@ -866,7 +867,7 @@ def scrape_amazon(url: str, html: str) -> Dict[str, Any]:
 
 
 def scrape_gamers(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'Images': [], 'Maker': '', 'Materials': '',
         'Modeler': '', 'PriceValue': '', 'PriceCurrency': '', 'PriceTaxIncluded': '',
@@ -905,7 +906,7 @@ def scrape_gamers(url: str, html: str) -> Dict[str, Any]:
 
 
 def scrape_animate(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'Images': [], 'Maker': '', 'Materials': '',
         'Modeler': '', 'PriceValue': '', 'PriceCurrency': '', 'PriceTaxIncluded': '',
@@ -959,7 +960,7 @@ def scrape_animate(url: str, html: str) -> Dict[str, Any]:
 
 
 def scrape_gamers(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'BodySource': '', 'Images': [],
         'Maker': '', 'Materials': '', 'Modeler': '',
@@ -1095,8 +1096,12 @@ def scrape_gamers(url: str, html: str) -> Dict[str, Any]:
             pass
     return out
 
-def scrape_detail(url: str) -> Dict[str, Any]:
-    html = fetch_html(url)
+def scrape_detail(url: str, use_cache: bool = True) -> Dict[str, Any]:
+    html = fetch_html(url, use_cache=use_cache)
+    return parse_detail(url, html)
+
+
+def parse_detail(url: str, html: str) -> Dict[str, Any]:
     host = urlparse(url).hostname or ''
     host = host.lower()
     if host.endswith('amiami.jp'):
@@ -1118,7 +1123,7 @@ def scrape_detail(url: str) -> Dict[str, Any]:
     if host.endswith('animate-onlineshop.jp'):
         return scrape_animate(url, html)
     # Fallback generic: capture title and basic images/text
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {'Title': '', 'Body': '', 'Images': []}
     t = soup.select_one('title, h1, h2')
     out['Title'] = g(t.text) if t else ''
@@ -1128,7 +1133,7 @@ def scrape_detail(url: str) -> Dict[str, Any]:
 
 
 def scrape_gamers2(url: str, html: str) -> Dict[str, Any]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = make_soup(html)
     out: Dict[str, Any] = {
         'Title': '', 'Body': '', 'BodySource': '', 'Images': [],
         'Maker': '', 'Materials': '', 'Modeler': '',
@@ -5,10 +5,13 @@ import json
 import os
 import re
 from datetime import datetime, timezone, timedelta
-from urllib.parse import urlparse, parse_qs
-import mimetypes
-import requests
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from . import sheets
 from .sheets import append_payloads
+from .http_client import set_host_delay
+from .parallel import submit
+from . import state_store, wp_mirror
 from .scrape_utils import g, title_to_key
 def _is_holoshop_url(url: str) -> bool:
     try:
@@ -52,6 +55,43 @@ def _now_jp() -> str:
         dt = datetime.utcnow() + timedelta(hours=9)
     # Match sheet expectation: YYYY/MM/DD HH:MM:SS
     return dt.strftime('%Y/%m/%d %H:%M:%S')
+# ======================== SourceHash signature ========================
+# v2: each field is normalized once and written as name, element count and
+# length-prefixed UTF-8 elements into a blake2b hasher, so list fields and
+# values containing '|' can't collide. Values are prefixed with the version.
+# Unprefixed values in the sheet are legacy v1 (MD5 over '|'-joined fields,
+# with the mirrored image URLs as written to the row's ImageURL);
+# sheet_hash_matches() compares those against a payload for the sheet dedup.
+SIGNATURE_VERSION = 'v2'
+SIGNATURE_FIELDS = (
+    'Title', 'Body', 'overview', 'Bonus',
+    'PriceValue', 'PriceTaxIncluded', 'PriceCurrency',
+    'PreorderStart', 'PreorderEnd', 'ReleaseDate', 'ShippingDate',
+    'Maker', 'Materials', 'Modeler', 'Character', 'Series', 'Tags', 'Copyright',
+    'Images',
+)
+def _canon_values(value: Any) -> List[str]:
+    if value is None:
+        return []
+    values = value if isinstance(value, (list, tuple)) else [value]
+    out: List[str] = []
+    for v in values:
+        if v is None:
+            continue
+        text = g(str(v))
+        if text:
+            out.append(text)
+    return out
+def source_signature(fields: Dict[str, Any]) -> str:
+    h = hashlib.blake2b(digest_size=16, person=b'holo-sourcehash')
+    for name in SIGNATURE_FIELDS:
+        values = _canon_values(fields.get(name))
+        h.update(f"{name}:{len(values)};".encode('ascii'))
+        for v in values:
+            raw = v.encode('utf-8')
+            h.update(len(raw).to_bytes(4, 'big'))
+            h.update(raw)
+    return f"{SIGNATURE_VERSION}:{h.hexdigest()}"
 def _hash(s: str) -> str:
     return hashlib.md5(s.encode('utf-8')).hexdigest()
 def _sig_value(value: Any) -> str:
@@ -61,6 +101,42 @@ def _sig_value(value: Any) -> str:
         parts = [_sig_value(v) for v in value if v is not None]
         return '|'.join([p for p in parts if p])
     return g(str(value))
+def _legacy_source_hash(fields: Dict[str, Any]) -> str:
+    """v1 SourceHash (MD5), kept only to compare against older sheet rows.
+
+    `Images` must be the URLs that were written to the sheet (WP mirrors).
+    """
+    parts = [_sig_value(fields.get('Title')), _sig_value(fields.get('Body'))[:2000]]
+    parts += [_sig_value(fields.get(k)) for k in SIGNATURE_FIELDS[2:-1]]
+    parts.append('|'.join(str(im) for im in (fields.get('Images') or [])))
+    return _hash('|'.join(parts))
+def source_hash_matches(stored: str, fields: Dict[str, Any]) -> bool:
+    """Compare a stored SourceHash (any version) with the signature of `fields`."""
+    stored = str(stored or '').strip()
+    if not stored:
+        return False
+    if ':' in stored:
+        return stored == source_signature(fields)
+    return stored == _legacy_source_hash(fields)
+def _split_image_field(value: Any) -> List[str]:
+    text = str(value or '').strip()
+    return [u.strip() for u in re.split(r',\s*\n', text) if u.strip()] if text else []
+def sheet_hash_matches(stored: str, payload: Dict[str, Any], row_images: Any = '') -> bool:
+    """Whether a sheet row's SourceHash already covers `payload`.
+
+    v2 values are compared with the payload's own SourceHash. A legacy v1
+    value hashed the mirrored image URLs, so it is recomputed from the
+    payload's fields with the row's ImageURL cell (`row_images`) in place of
+    this run's mirrors.
+    """
+    stored = str(stored or '').strip()
+    if not stored:
+        return False
+    if ':' in stored:
+        return stored == str(payload.get('SourceHash') or '').strip()
+    fields = {k: payload.get(k) for k in SIGNATURE_FIELDS}
+    fields['Images'] = _split_image_field(row_images)
+    return source_hash_matches(stored, fields)
 PROMPT_FIELDS = (
     'Title',
     'Body',
@@ -85,109 +161,23 @@ def _build_prompt_payload(detail: Dict[str, Any]) -> Dict[str, str]:
 def _generate_body_with_gemini(detail: Dict[str, Any]) -> str | None:
     """Gemini generation moved to run_gemini.js (Google Apps Script)."""
     return None
-# ======================== WP image mirror (upload) ========================
-_WP_UPLOAD_CACHE: Dict[str, str] = {}
 def _env(name: str) -> str:
     return str(os.getenv(name, '')).strip()
-def _guess_filename(url: str, content_type: str | None) -> str:
-    try:
-        parsed = urlparse(url)
-        path = parsed.path or 'image'
-    except Exception:
-        path = 'image'
-    name = (path.rsplit('/', 1)[-1] or 'image').split('?', 1)[0].split('#', 1)[0]
-    # animate等のリサイズPHP形式 (?image=filename.jpg) から元のファイル名を復元
-    try:
-        if (not name or name.endswith('.php')) and parsed and parsed.query:
-            q = parse_qs(parsed.query)
-            img_param = q.get('image', [])
-            if img_param:
-                candidate = str(img_param[0]).split('/')[-1]
-                if candidate:
-                    name = candidate
-    except Exception:
-        pass
-    if not re.search(r"\.[A-Za-z0-9]{3,4}$", name or '') and content_type:
-        mapping = {
-            'image/jpeg': '.jpg',
-            'image/jpg': '.jpg',
-            'image/png': '.png',
-            'image/webp': '.webp',
-            'image/gif': '.gif',
-        }
-        ext = mapping.get(content_type.lower())
-        if ext and not name.endswith(ext):
-            name = (name or 'image') + ext
-    return name or 'image.jpg'
-def _wp_upload_image(session: requests.Session, site: str, auth: Tuple[str, str], image_url: str, referer: str) -> str | None:
-    # 既にWP配下のURLならそのまま返す
-    if image_url.startswith(site.rstrip('/') + '/'):
-        return image_url
-    if image_url in _WP_UPLOAD_CACHE:
-        return _WP_UPLOAD_CACHE.get(image_url)
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36',
-        'Accept': '*/*',
-        'Accept-Language': 'ja-JP,ja;q=0.9,en-US;q=0.8,en;q=0.7',
-        'Referer': referer or (site.rstrip('/') + '/'),
-    }
-    try:
-        # Warm-up referer to get cookies if needed
-        if referer:
-            try:
-                session.get(referer, headers={'User-Agent': headers['User-Agent'], 'Accept': 'text/html,*/*;q=0.8'}, timeout=12, allow_redirects=True)
-            except Exception:
-                pass
-        r = session.get(image_url, headers=headers, timeout=20, allow_redirects=True)
-        if not (200 <= r.status_code < 300):
-            return None
-        ct = (r.headers.get('Content-Type') or '').split(';')[0].strip()
-        filename = _guess_filename(image_url, ct)
-        # Content-Type が無い/汎用の場合は拡張子から推測
-        if not ct or ct.lower() == 'application/octet-stream':
-            guessed, _ = mimetypes.guess_type(filename)
-            ct = guessed or 'image/jpeg'
-        files = {'file': (filename, r.content, ct)}
-        media_url = site.rstrip('/') + '/wp-json/wp/v2/media'
-        up = session.post(media_url, headers={'User-Agent': headers['User-Agent']}, files=files, auth=auth, timeout=30)
-        if 200 <= up.status_code < 300:
-            try:
-                data = up.json()
-            except Exception:
-                return None
-            src = data.get('source_url') or (data.get('guid') or {}).get('rendered')
-            if src:
-                _WP_UPLOAD_CACHE[image_url] = str(src)
-                return str(src)
-    except Exception:
-        return None
-    return None
 def _mirror_images_to_wp(urls: List[str], referer: str) -> List[str]:
-    site = _env('WP_SITE_URL')
-    user = _env('WP_USER')
-    app = _env('WP_APP_PASSWORD')
-    if not (site and user and app):
-        return urls
-    s = requests.Session()
-    out: List[str] = []
-    for u in urls:
-        wp = _wp_upload_image(s, site, (user, app), u, referer)
-        out.append(wp or u)
-    return out
-def build_payload(url: str, detail: Dict[str, Any] | None = None) -> Dict[str, Any]:
+    return wp_mirror.mirror_images(urls, referer)
+class PayloadUnchanged(Exception):
+    """Raised by build_payload when the detail content matches the last written SourceHash."""
+
+    def __init__(self, url: str, source_hash: str):
+        super().__init__(f"unchanged since last write ({source_hash[:12]})")
+        self.url = url
+        self.source_hash = source_hash
+def build_payload(url: str, detail: Dict[str, Any] | None = None, skip_unchanged: bool = False,
+                  use_cache: bool = True) -> Dict[str, Any]:
     from .detail_scrapers import scrape_detail
-    detail_data = detail if detail is not None else scrape_detail(url)
+    detail_data = detail if detail is not None else scrape_detail(url, use_cache=use_cache)
     imgs = detail_data.get('Images') or []
     imgs = [str(im).strip() for im in imgs if im]
-    # Mirror images to WordPress and use returned URLs when possible
-    if imgs:
-        try:
-            mirrored = _mirror_images_to_wp(imgs, url)
-            if mirrored and any(mirrored):
-                imgs = mirrored
-        except Exception:
-            pass
-    image_field = ',\n'.join(imgs) if len(imgs) > 1 else (imgs[0] if imgs else '')
     title = detail_data.get('Title') or ''
     if not title:
         fallback_title = detail_data.get('Character')
@@ -205,29 +195,21 @@ def build_payload(url: str, detail: Dict[str, Any] | None = None) -> Dict[str, A
     body_source = json.dumps(prompt_payload, ensure_ascii=False)
     gemini_body = _generate_body_with_gemini(detail_data)
     final_body = gemini_body if gemini_body else body
-    body_norm = _sig_value(body)[:2000]
-    signature_parts = [
-        _sig_value(title),
-        body_norm,
-        _sig_value(overview),
-        _sig_value(bonus),
-        _sig_value(detail_data.get('PriceValue')),
-        _sig_value(detail_data.get('PriceTaxIncluded')),
-        _sig_value(detail_data.get('PriceCurrency')),
-        _sig_value(detail_data.get('PreorderStart')),
-        _sig_value(detail_data.get('PreorderEnd')),
-        _sig_value(detail_data.get('ReleaseDate')),
-        _sig_value(detail_data.get('ShippingDate')),
-        _sig_value(detail_data.get('Maker')),
-        _sig_value(detail_data.get('Materials')),
-        _sig_value(detail_data.get('Modeler')),
-        _sig_value(detail_data.get('Character')),
-        _sig_value(detail_data.get('Series')),
-        _sig_value(detail_data.get('Tags')),
-        _sig_value(detail_data.get('Copyright')),
-        '|'.join(imgs),
-    ]
-    source_hash = _hash('|'.join(signature_parts))
+    sig_fields = {k: detail_data.get(k) for k in SIGNATURE_FIELDS}
+    # Source (pre-mirror) image URLs, so the hash is known before uploading
+    sig_fields.update({'Title': title, 'Body': body, 'overview': overview, 'Bonus': bonus, 'Images': imgs})
+    source_hash = source_signature(sig_fields)
+    if skip_unchanged and url and source_hash_matches(state_store.get_store().source_hash(url), sig_fields):
+        raise PayloadUnchanged(url, source_hash)
+    # Mirror images to WordPress and use returned URLs when possible
+    if imgs:
+        try:
+            mirrored = _mirror_images_to_wp(imgs, url)
+            if mirrored and any(mirrored):
+                imgs = mirrored
+        except Exception:
+            pass
+    image_field = ',\n'.join(imgs) if len(imgs) > 1 else (imgs[0] if imgs else '')
     title_key = title_to_key(title)
     payload = {
         'Date': _now_jp(),
@@ -270,13 +252,67 @@ def build_payload(url: str, detail: Dict[str, Any] | None = None) -> Dict[str, A
         'status': '',
     }
     return payload
-def on_change(site: Dict, change_items: List[Dict]) -> Tuple[List[Dict], List[str], int]:
+def _detail_workers() -> int:
+    try:
+        return max(1, int(_env('HOOK_DETAIL_WORKERS') or 4))
+    except ValueError:
+        return 4
+def _register_detail_delays(site: Dict, change_items: List[Dict]) -> None:
+    try:
+        delay = float(site.get('detail_delay_seconds') or 0)
+    except (TypeError, ValueError):
+        delay = 0.0
+    if delay <= 0:
+        return
+    try:
+        burst = float(site.get('detail_burst') or 1)
+    except (TypeError, ValueError):
+        burst = 1.0
+    hosts = set()
+    for item in change_items:
+        url = item.get('url') or item.get('SourceURL') or ''
+        try:
+            host = (urlparse(url).hostname or '').lower()
+        except Exception:
+            host = ''
+        if host:
+            hosts.add(host)
+    for host in hosts:
+        set_host_delay(host, delay, burst)
+def _record_source_hashes(site_id: str, payloads: List[Dict]) -> None:
+    pairs = [(str(p.get('SourceURL') or ''), str(p.get('SourceHash') or '')) for p in payloads]
+    pairs = [(u, h) for u, h in pairs if u and h]
+    if not pairs:
+        return
+    try:
+        state_store.get_store().record_source_hashes(pairs)
+    except Exception as exc:
+        print(f"[HOOK] {site_id} failed to record SourceHash: {exc}", flush=True)
+def begin_buffered_writes() -> None:
+    """Queue on_change sheet writes until flush_buffered_writes()."""
+    sheets.start_run_buffer()
+def flush_buffered_writes() -> Dict[str, Dict]:
+    """Commit queued payloads in one pass; returns per-site {'queued', 'wrote', 'skipped', 'error', 'payloads'}."""
+    results = sheets.flush_run_buffer()
+    for site_id, res in results.items():
+        _record_source_hashes(site_id, res.get('payloads') or [])
+    return results
+def on_change(site: Dict, change_items: List[Dict], skip_unchanged: bool = True) -> Tuple[List[Dict], List[str], int]:
+    """Build payloads for changed items and append them to the sheet.
+
+    With skip_unchanged, items whose detail content hashes to the SourceHash
+    recorded at their last successful write are dropped before image
+    mirroring and the sheet append. Updated items and items carried over
+    from the backlog bypass the detail page cache, since a cached copy may
+    predate the change that queued them.
+    """
     site_id = site.get('id') or 'site'
     total = len(change_items)
     print(f"[HOOK] {site_id} start change processing ({total} item(s))", flush=True)
-    payloads: List[Dict] = []
-    errors: List[str] = []
-    for index, item in enumerate(change_items, 1):
+    _register_detail_delays(site, change_items)
+    skipped: List[str] = []
+
+    def _build(index: int, item: Dict) -> Tuple[Dict | None, str | None]:
         payload = item.get('payload')
         url = item.get('url') or item.get('SourceURL') or ''
         detail_data = item.get('detail_data')
@@ -284,21 +320,45 @@ def on_change(site: Dict, change_items: List[Dict]) -> Tuple[List[Dict], List[st
         print(f"[HOOK] {site_id} building payload {index}/{total}: {display_target}", flush=True)
         if payload is None:
             try:
-                payload = build_payload(url, detail_data)
+                fresh = item.get('ChangeType') == 'updated' or bool(item.get('from_backlog'))
+                payload = build_payload(url, detail_data, skip_unchanged=skip_unchanged, use_cache=not fresh)
+            except PayloadUnchanged as exc:
+                print(f"[HOOK] {site_id} skip {display_target}: {exc}", flush=True)
+                skipped.append(url)
+                return None, None
             except Exception as exc:
                 err_msg = f"{display_target}: {exc}"
-                errors.append(err_msg)
                 print(f"[HOOK] {site_id} payload error: {err_msg}", flush=True)
-                continue
-        payloads.append(payload)
+                return None, err_msg
+        if item.get('ChangeType') and isinstance(payload, dict):
+            payload.setdefault('ChangeType', item['ChangeType'])
+        return payload, None
+
+    # Detail fetches run on a bounded pool; per-host pacing is enforced by
+    # http_client.throttle inside fetch_html. Results keep the input order.
+    workers = min(_detail_workers(), total) if total else 1
+    if workers <= 1:
+        results = [_build(i, it) for i, it in enumerate(change_items, 1)]
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"hook-{site_id}") as pool:
+            futures = [submit(pool, _build, i, it) for i, it in enumerate(change_items, 1)]
+            results = [f.result() for f in futures]
+    payloads: List[Dict] = [p for p, _ in results if p is not None]
+    errors: List[str] = [e for _, e in results if e]
     wrote = 0
-    if payloads:
+    buffer = sheets.run_buffer()
+    if payloads and buffer is not None:
+        # Written with every other site's rows by flush_buffered_writes()
+        queued = buffer.add(site_id, payloads)
+        print(f"[HOOK] {site_id} queued {queued} payload(s) for the run's sheet commit", flush=True)
+    elif payloads:
         print(f"[HOOK] {site_id} appending {len(payloads)} payload(s) to sheet", flush=True)
         try:
             wrote = append_payloads(payloads)
+            _record_source_hashes(site_id, payloads)
         except Exception as exc:
             err_msg = f"sheets: {exc}"
             errors.append(err_msg)
             print(f"[HOOK] {site_id} sheet error: {err_msg}", flush=True)
-    print(f"[HOOK] {site_id} processed {len(payloads)} change(s), wrote {wrote}, errors={len(errors)}", flush=True)
+    print(f"[HOOK] {site_id} processed {len(payloads)} change(s), wrote {wrote}, skipped unchanged={len(skipped)}, errors={len(errors)}", flush=True)
     return payloads, errors, wrote
@@ -0,0 +1,248 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+from urllib.parse import urlparse
+
+# On-disk response cache for detail pages and images.
+#
+# Layout under HTTP_CACHE_DIR (default .cache/http):
+#   meta/<sha256(url)>.json  -> url, status, headers, encoding, stored_at, blob
+#   blobs/<sha256(body)>     -> body bytes (zlib-compressed for text types)
+# Bodies are content-addressed, so identical pages/images fetched through
+# different URLs are stored once. Entries expire per host (see
+# set_host_ttl); the total blob size is capped and the least recently used
+# entries (meta mtime is bumped on every hit) are evicted first.
+
+_LOCK = threading.Lock()
+_HOST_TTL: Dict[str, float] = {}
+_TOTAL_BYTES: int | None = None
+
+_COMPRESSIBLE = ('text/', 'application/json', 'application/xml', 'application/xhtml', 'application/javascript')
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    status_code: int
+    headers: Dict[str, str]
+    content: bytes
+    encoding: str | None
+    stored_at: float
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+
+def _env(name: str, default: str = '') -> str:
+    return str(os.getenv(name, default)).strip()
+
+
+def enabled() -> bool:
+    return _env('HTTP_CACHE', '1').lower() not in ('0', 'false', 'no', 'off')
+
+
+def _offline() -> bool:
+    # Serve any cached entry regardless of age (for reproducing parser bugs).
+    return _env('HTTP_CACHE_OFFLINE').lower() in ('1', 'true', 'yes', 'on')
+
+
+def _root() -> str:
+    return _env('HTTP_CACHE_DIR') or os.path.join('.cache', 'http')
+
+
+def _max_bytes() -> int:
+    try:
+        return int(float(_env('HTTP_CACHE_MAX_MB') or 256) * 1024 * 1024)
+    except ValueError:
+        return 256 * 1024 * 1024
+
+
+def _default_ttl() -> float:
+    try:
+        return float(_env('HTTP_CACHE_TTL_SECONDS') or 6 * 3600)
+    except ValueError:
+        return 6 * 3600.0
+
+
+def _host_of(url: str) -> str:
+    try:
+        return (urlparse(url).hostname or '').lower()
+    except Exception:
+        return ''
+
+
+def set_host_ttl(host: str, seconds: float) -> None:
+    host = (host or '').lower().strip()
+    if not host:
+        return
+    try:
+        _HOST_TTL[host] = max(0.0, float(seconds))
+    except (TypeError, ValueError):
+        pass
+
+
+def register_site_ttl(site: Dict[str, Any]) -> None:
+    """Apply a site's `cache_ttl_seconds` to its monitor host."""
+    ttl = site.get('cache_ttl_seconds')
+    if ttl is None:
+        return
+    set_host_ttl(_host_of(str(site.get('monitor_url') or '')), ttl)
+
+
+def _ttl_for(url: str) -> float:
+    return _HOST_TTL.get(_host_of(url), _default_ttl())
+
+
+def _meta_path(url: str) -> str:
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(_root(), 'meta', key + '.json')
+
+
+def _blob_path(digest: str) -> str:
+    return os.path.join(_root(), 'blobs', digest)
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def get(url: str) -> CachedResponse | None:
+    """Return a fresh cached response for `url`, or None."""
+    if not enabled():
+        return None
+    path = _meta_path(url)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        stored_at = float(meta.get('stored_at') or 0)
+        ttl = _ttl_for(url)
+        if not _offline() and (ttl <= 0 or time.time() - stored_at > ttl):
+            return None
+        with open(_blob_path(meta['blob']), 'rb') as f:
+            body = f.read()
+        if meta.get('compressed'):
+            body = zlib.decompress(body)
+        os.utime(path, None)
+    except Exception:
+        return None
+    return CachedResponse(
+        url=url,
+        status_code=int(meta.get('status') or 200),
+        headers=dict(meta.get('headers') or {}),
+        content=body,
+        encoding=meta.get('encoding'),
+        stored_at=stored_at,
+    )
+
+
+def put(url: str, status_code: int, headers: Dict[str, str] | Any, content: bytes, encoding: str | None = None) -> None:
+    """Store a successful response. Errors are swallowed (cache is best-effort)."""
+    if not enabled() or not (200 <= int(status_code) < 300) or content is None:
+        return
+    try:
+        keep = ('Content-Type', 'ETag', 'Last-Modified', 'Content-Length')
+        hdrs = {k: str(headers.get(k)) for k in keep if headers.get(k)}
+        ctype = hdrs.get('Content-Type', '').lower()
+        digest = hashlib.sha256(content).hexdigest()
+        compress = ctype.startswith(_COMPRESSIBLE)
+        blob = _blob_path(digest)
+        added = 0
+        if not os.path.exists(blob):
+            data = zlib.compress(content, 6) if compress else content
+            _atomic_write(blob, data)
+            added = len(data)
+        meta = {
+            'url': url,
+            'status': int(status_code),
+            'headers': hdrs,
+            'encoding': encoding,
+            'stored_at': time.time(),
+            'blob': digest,
+            'compressed': compress,
+        }
+        _atomic_write(_meta_path(url), json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+        _account(added)
+    except Exception:
+        pass
+
+
+def _scan() -> Tuple[List[Tuple[float, str, str]], Dict[str, int]]:
+    """Return (meta entries as (mtime, path, blob), blob sizes)."""
+    root = _root()
+    metas: List[Tuple[float, str, str]] = []
+    sizes: Dict[str, int] = {}
+    blob_dir = os.path.join(root, 'blobs')
+    meta_dir = os.path.join(root, 'meta')
+    if os.path.isdir(blob_dir):
+        for name in os.listdir(blob_dir):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                sizes[name] = os.path.getsize(os.path.join(blob_dir, name))
+            except OSError:
+                pass
+    if os.path.isdir(meta_dir):
+        for name in os.listdir(meta_dir):
+            if not name.endswith('.json'):
+                continue
+            p = os.path.join(meta_dir, name)
+            try:
+                with open(p, 'r', encoding='utf-8') as f:
+                    blob = json.load(f).get('blob') or ''
+                metas.append((os.path.getmtime(p), p, blob))
+            except Exception:
+                continue
+    return metas, sizes
+
+
+def _account(added: int) -> None:
+    global _TOTAL_BYTES
+    with _LOCK:
+        if _TOTAL_BYTES is None:
+            _TOTAL_BYTES = sum(_scan()[1].values())
+        else:
+            _TOTAL_BYTES += added
+        if _TOTAL_BYTES > _max_bytes():
+            _TOTAL_BYTES = _evict(_max_bytes())
+
+
+def _evict(limit: int) -> int:
+    """Drop least recently used entries until blobs fit in ~90% of `limit`."""
+    metas, sizes = _scan()
+    total = sum(sizes.values())
+    target = int(limit * 0.9)
+    refs: Dict[str, int] = {}
+    for _, _, blob in metas:
+        refs[blob] = refs.get(blob, 0) + 1
+    for blob in [b for b in sizes if b not in refs]:
+        try:
+            os.remove(_blob_path(blob))
+            total -= sizes.pop(blob)
+        except OSError:
+            pass
+    for _, path, blob in sorted(metas):
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        refs[blob] = refs.get(blob, 1) - 1
+        if refs[blob] <= 0 and blob in sizes:
+            try:
+                os.remove(_blob_path(blob))
+                total -= sizes.pop(blob)
+            except OSError:
+                pass
+    return total
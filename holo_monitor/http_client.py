@@ -0,0 +1,342 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .scheduler import TokenBucket
+
+# Process-wide pooled session shared by runner/detail_scrapers/hooks/notify.
+# urllib3 keeps one connection pool per host inside the adapter, so repeated
+# requests to the same shop reuse keep-alive connections instead of paying a
+# fresh TCP+TLS handshake each time.
+_SESSION: requests.Session | None = None
+_SESSION_LOCK = threading.Lock()
+_ENGINE = ''
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(str(os.getenv(name, '')).strip() or default)
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(str(os.getenv(name, '')).strip() or default)
+    except ValueError:
+        return default
+
+
+def _build_retry() -> Retry:
+    retries = _env_int('HTTP_RETRIES', 2)
+    # Only idempotent methods are retried at the transport level; POSTs
+    # (WordPress uploads, Discord webhooks) are left to the callers.
+    return Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        status_forcelist=(429, 500, 502, 504),
+        allowed_methods=frozenset({'GET', 'HEAD'}),
+        backoff_factor=_env_float('HTTP_RETRY_BACKOFF', 0.5),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+def _build_session() -> requests.Session:
+    pool_size = max(1, _env_int('HTTP_POOL_SIZE', 10))
+    adapter = HTTPAdapter(
+        pool_connections=max(1, _env_int('HTTP_POOL_HOSTS', 16)),
+        pool_maxsize=pool_size,
+        max_retries=_build_retry(),
+        pool_block=False,
+    )
+    s = requests.Session()
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    s.headers['Connection'] = 'keep-alive'
+    return s
+
+
+def engine_name() -> str:
+    """'requests' (default) or 'async', from set_engine() or HOLO_FETCH_ENGINE."""
+    name = _ENGINE or str(os.getenv('HOLO_FETCH_ENGINE', '')).strip().lower()
+    return 'async' if name in ('async', 'asyncio', 'httpx', 'aiohttp') else 'requests'
+
+
+def set_engine(name: str) -> None:
+    """Select the fetch engine; must be called before the first get_session()."""
+    global _ENGINE
+    _ENGINE = str(name or '').strip().lower()
+
+
+def _build_async_session(fallback: requests.Session) -> Any:
+    from .async_engine import AsyncEngine, AsyncSession, available_backend
+    backend = available_backend()
+    if not backend:
+        print('[http] async engine requested but neither httpx nor aiohttp is installed; using requests', flush=True)
+        return fallback
+    engine = AsyncEngine(
+        backend,
+        pool_size=max(1, _env_int('HTTP_POOL_SIZE', 10)),
+        total_connections=max(1, _env_int('HTTP_MAX_CONNECTIONS', 100)),
+        cookies=fallback.cookies,
+    )
+    print(f"[http] using async fetch engine ({backend})", flush=True)
+    return AsyncSession(engine, fallback)
+
+
+def get_session() -> requests.Session:
+    """Return the shared pooled session, creating it on first use.
+
+    Pool size, host count and retry policy are read from HTTP_POOL_SIZE,
+    HTTP_POOL_HOSTS, HTTP_RETRIES and HTTP_RETRY_BACKOFF. With the async
+    engine selected this is an AsyncSession exposing the same get/head/post
+    calls over a single event loop.
+    """
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                session = _build_session()
+                if engine_name() == 'async':
+                    session = _build_async_session(session)
+                _SESSION = session
+    return _SESSION
+
+
+def close_session() -> None:
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            try:
+                _SESSION.close()
+            except Exception:
+                pass
+            _SESSION = None
+
+
+# ======================== Host warm-up registry ========================
+# Some shops only serve product pages once a session cookie has been issued by
+# their top page. Sites declare the page to hit in sites.yaml (`warmup_url`);
+# each warm-up URL is fetched at most once per WARMUP_TTL_SECONDS and the
+# cookies it sets stay in the shared session for every later request.
+_WARMUP_BY_HOST: Dict[str, List[str]] = {}
+_WARMED_AT: Dict[str, float] = {}
+_WARMING: Dict[str, threading.Event] = {}
+_WARMUP_LOCK = threading.Lock()
+
+
+def _host_of(url: str) -> str:
+    try:
+        return (urlparse(url).hostname or '').lower()
+    except Exception:
+        return ''
+
+
+def register_warmup(host: str, warmup_url: str) -> None:
+    host = (host or '').lower().strip()
+    warmup_url = str(warmup_url or '').strip()
+    if not host or not warmup_url:
+        return
+    with _WARMUP_LOCK:
+        urls = _WARMUP_BY_HOST.setdefault(host, [])
+        if warmup_url not in urls:
+            urls.append(warmup_url)
+
+
+def register_site_warmups(site: Dict[str, Any]) -> None:
+    """Register a site's `warmup_url` (str or list) for its monitor host and
+    for the host of each warm-up URL itself (detail pages often live there)."""
+    raw = site.get('warmup_url') or site.get('warmup_urls') or []
+    urls = [raw] if isinstance(raw, str) else list(raw or [])
+    monitor_host = _host_of(str(site.get('monitor_url') or ''))
+    for u in urls:
+        u = str(u or '').strip()
+        if not u:
+            continue
+        if monitor_host:
+            register_warmup(monitor_host, u)
+        register_warmup(_host_of(u), u)
+
+
+def warmup_urls_for(host: str) -> List[str]:
+    host = (host or '').lower()
+    with _WARMUP_LOCK:
+        return list(_WARMUP_BY_HOST.get(host, []))
+
+
+def warm_up(url: str, headers: Dict[str, str] | None = None, timeout: float = 30) -> bool:
+    """GET `url` once per TTL to collect cookies. Returns True if a request was sent.
+
+    Callers arriving while another thread is warming the same URL wait for
+    it to finish (up to `timeout`), so their own request carries the cookies.
+    """
+    ttl = _env_float('WARMUP_TTL_SECONDS', 1800.0)
+    now = time.monotonic()
+    with _WARMUP_LOCK:
+        running = _WARMING.get(url)
+        if running is None:
+            last = _WARMED_AT.get(url)
+            if last is not None and now - last < ttl:
+                return False
+            done = _WARMING[url] = threading.Event()
+    if running is not None:
+        running.wait(timeout)
+        return False
+    try:
+        get_session().get(url, headers=headers, timeout=timeout)
+    except Exception:
+        pass
+    finally:
+        # A failed warm-up is not retried within the TTL either
+        with _WARMUP_LOCK:
+            _WARMED_AT[url] = now
+            _WARMING.pop(url, None)
+        done.set()
+    return True
+
+
+def ensure_host_warm(url: str, headers: Dict[str, str] | None = None) -> List[str]:
+    """Run any registered warm-ups for the host of `url`; returns their URLs."""
+    urls = warmup_urls_for(_host_of(url))
+    for u in urls:
+        warm_up(u, headers=headers)
+    return urls
+
+
+# ======================== Per-host politeness ========================
+# Each host with a configured delay gets a token bucket refilled at one token
+# per `delay` seconds. With the default burst of 1 this is a plain minimum
+# spacing; callers reserve a token under the bucket's lock and sleep outside
+# it, so concurrent workers on one shop are paced while other hosts proceed.
+_HOST_BUCKETS: Dict[str, TokenBucket] = {}
+_THROTTLE_LOCK = threading.Lock()
+
+
+def set_host_delay(host: str, seconds: float, burst: float = 1) -> None:
+    host = (host or '').lower().strip()
+    if not host:
+        return
+    try:
+        seconds = max(0.0, float(seconds or 0))
+    except (TypeError, ValueError):
+        seconds = 0.0
+    with _THROTTLE_LOCK:
+        current = _HOST_BUCKETS.get(host)
+        if seconds <= 0:
+            _HOST_BUCKETS.pop(host, None)
+        elif current is None or current.rate != 1.0 / seconds or current.capacity != max(float(burst or 1), 1.0):
+            _HOST_BUCKETS[host] = TokenBucket(1.0 / seconds, burst or 1)
+
+
+def throttle(url: str) -> float:
+    """Block until `url`'s host may be hit again; returns the seconds waited."""
+    with _THROTTLE_LOCK:
+        bucket = _HOST_BUCKETS.get(_host_of(url))
+    if bucket is None:
+        return 0.0
+    return bucket.acquire()
+
+
+# ======================== Conditional GET validators ========================
+# ETag / Last-Modified / body hash per monitor URL, stored next to the state
+# files. fetch_html stages a fresh record on every 200; the caller commits it
+# once the page has been fully processed, so a run that dies halfway will
+# re-fetch and re-process the page next time instead of skipping it.
+_VALIDATORS: Dict[str, Dict[str, str]] | None = None
+_PENDING_VALIDATORS: Dict[str, Dict[str, str]] = {}
+_VALIDATOR_LOCK = threading.Lock()
+
+
+class NotModified(Exception):
+    """Raised by a conditional fetch when the resource is unchanged."""
+
+    def __init__(self, url: str, reason: str):
+        super().__init__(f"{url} not modified ({reason})")
+        self.url = url
+        self.reason = reason
+
+
+def conditional_enabled() -> bool:
+    return str(os.getenv('HTTP_CONDITIONAL', '1')).strip().lower() not in ('0', 'false', 'no', 'off')
+
+
+def _validators_path() -> str:
+    return str(os.getenv('HTTP_VALIDATORS_FILE', '') or 'state/http_validators.json').strip()
+
+
+def _load_validators() -> Dict[str, Dict[str, str]]:
+    global _VALIDATORS
+    if _VALIDATORS is None:
+        data: Dict[str, Dict[str, str]] = {}
+        path = _validators_path()
+        try:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    raw = json.load(f)
+                if isinstance(raw, dict):
+                    data = {str(k): v for k, v in raw.items() if isinstance(v, dict)}
+        except Exception:
+            data = {}
+        _VALIDATORS = data
+    return _VALIDATORS
+
+
+def conditional_headers(url: str) -> Dict[str, str]:
+    with _VALIDATOR_LOCK:
+        rec = _load_validators().get(url) or {}
+    headers: Dict[str, str] = {}
+    if rec.get('etag'):
+        headers['If-None-Match'] = rec['etag']
+    if rec.get('last_modified'):
+        headers['If-Modified-Since'] = rec['last_modified']
+    return headers
+
+
+def check_unchanged(url: str, resp: requests.Response) -> None:
+    """Raise NotModified for a 304 or an identical body; otherwise stage validators."""
+    if resp.status_code == 304:
+        raise NotModified(url, '304')
+    if not resp.ok:
+        return
+    body_hash = hashlib.sha256(resp.content or b'').hexdigest()
+    with _VALIDATOR_LOCK:
+        prev = _load_validators().get(url) or {}
+    if prev.get('sha256') == body_hash:
+        raise NotModified(url, 'same content hash')
+    rec = {'sha256': body_hash}
+    if resp.headers.get('ETag'):
+        rec['etag'] = resp.headers['ETag']
+    if resp.headers.get('Last-Modified'):
+        rec['last_modified'] = resp.headers['Last-Modified']
+    with _VALIDATOR_LOCK:
+        _PENDING_VALIDATORS[url] = rec
+
+
+def commit_validators(url: str) -> None:
+    """Persist the validators staged for `url` by the last conditional fetch."""
+    with _VALIDATOR_LOCK:
+        rec = _PENDING_VALIDATORS.pop(url, None)
+        if rec is None:
+            return
+        data = _load_validators()
+        data[url] = rec
+        path = _validators_path()
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp, path)
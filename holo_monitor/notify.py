@@ -1,7 +1,14 @@
-import requests
-from typing import List, Dict, Any
+from __future__ import annotations
+import os
+import queue
+import threading
+import time
+from typing import List, Dict, Any, Tuple
+
+from .http_client import get_session
 
 MAX_ITEM_LINES = 5
+MAX_CONTENT_CHARS = 2000
 
 
 def _pick_str(source: Dict[str, Any], *keys: str) -> str:
@@ -72,10 +79,7 @@ def send_discord_summary(webhook_url: str, site: Dict, payloads: List[Dict]) ->
     if lines:
         content_lines.extend(lines)
     content = '\n'.join(content_lines)
-    try:
-        requests.post(webhook_url, json={"content": content}, timeout=20)
-    except Exception:
-        pass
+    _post(webhook_url, content, site_id)
 
 
 def send_discord_change_summary(webhook_url: str, site: Dict, payloads: List[Dict]) -> None:
@@ -93,7 +97,171 @@ def send_discord_error(webhook_url: str, site: Dict, errors: List[str]) -> None:
     lines = [f"**{site_id} errors**"]
     lines.extend(error.strip() for error in errors[:10] if isinstance(error, str) and error.strip())
     content = '\n'.join(lines)
+    _post(webhook_url, content, site_id)
+
+
+# ======================== delivery ========================
+# Webhook posts retry on 429 (waiting Retry-After / retry_after) and 5xx up
+# to NOTIFY_RETRIES times (default 5). During a monitor run messages go
+# through a NotificationQueue instead: a background thread holds them per
+# webhook and merges them into as few posts as fit Discord's 2000-character
+# limit. A merged message is sent as soon as it is full, when its oldest
+# part has waited NOTIFY_MAX_AGE_SECONDS (default 300), or when the run
+# closes the queue, so scraping never waits on Discord.
+
+def _env_float(name: str, default: float) -> float:
     try:
-        requests.post(webhook_url, json={"content": content}, timeout=20)
-    except Exception:
+        return float(os.getenv(name, '') or default)
+    except ValueError:
+        return default
+
+
+def _retry_after(resp: Any) -> float:
+    try:
+        return float(resp.headers.get('Retry-After'))
+    except (TypeError, ValueError):
         pass
+    try:
+        return float((resp.json() or {}).get('retry_after'))
+    except Exception:
+        return 1.0
+
+
+def _deliver(webhook_url: str, content: str, stats: Dict[str, int] | None = None) -> bool:
+    """POST one message; returns True once Discord accepted it."""
+    retries = max(0, int(_env_float('NOTIFY_RETRIES', 5)))
+    for attempt in range(retries + 1):
+        try:
+            resp = get_session().post(webhook_url, json={"content": content}, timeout=20)
+        except Exception:
+            resp = None
+        if stats is not None:
+            stats['posts'] = stats.get('posts', 0) + 1
+        if resp is not None and 200 <= resp.status_code < 300:
+            return True
+        if resp is not None and resp.status_code == 429:
+            if stats is not None:
+                stats['rate_limited'] = stats.get('rate_limited', 0) + 1
+            delay = _retry_after(resp)
+        elif resp is None or resp.status_code >= 500:
+            delay = min(30.0, 2 ** attempt)
+        else:
+            return False
+        if attempt < retries:
+            time.sleep(min(60.0, max(0.0, delay)))
+    return False
+
+
+def _coalesce(items: List[Tuple[str, str]], limit: int = MAX_CONTENT_CHARS) -> List[Tuple[str, List[str]]]:
+    """Merge (content, site_id) pairs into messages of at most `limit` chars."""
+    out: List[Tuple[str, List[str]]] = []
+    for content, site_id in items:
+        if len(content) > limit:
+            content = content[:limit - 3] + '...'
+        if out and len(out[-1][0]) + 2 + len(content) <= limit:
+            out[-1] = (out[-1][0] + '\n\n' + content, out[-1][1] + [site_id])
+        else:
+            out.append((content, [site_id]))
+    return out
+
+
+_STOP = object()
+
+
+class NotificationQueue:
+    def __init__(self) -> None:
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Any] = {'queued': 0, 'posts': 0, 'delivered': 0, 'failed': 0, 'rate_limited': 0, 'sites': {}}
+        self._thread = threading.Thread(target=self._worker, name='discord-notify', daemon=True)
+        self._thread.start()
+
+    def put(self, webhook_url: str, content: str, site_id: str) -> None:
+        with self._lock:
+            self.stats['queued'] += 1
+        self._queue.put((webhook_url, content, site_id))
+
+    def _worker(self) -> None:
+        max_age = max(0.0, _env_float('NOTIFY_MAX_AGE_SECONDS', 300))
+        # webhook -> (content, site_id) not sent yet, and when the oldest of them arrived
+        pending: Dict[str, List[Tuple[str, str]]] = {}
+        since: Dict[str, float] = {}
+        while True:
+            timeout = max(0.0, min(since.values()) + max_age - time.monotonic()) if since else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                for webhook_url, items in pending.items():
+                    self._send(webhook_url, _coalesce(items))
+                return
+            if item is not None:
+                webhook_url, content, site_id = item
+                items = pending.setdefault(webhook_url, [])
+                items.append((content, site_id))
+                since.setdefault(webhook_url, time.monotonic())
+                merged = _coalesce(items)
+                if len(merged) > 1:
+                    # Full messages go out now; the last, partly filled one keeps waiting
+                    keep = len(merged[-1][1])
+                    self._send(webhook_url, merged[:-1])
+                    pending[webhook_url] = items[-keep:]
+                    since[webhook_url] = time.monotonic()
+            now = time.monotonic()
+            for webhook_url in [w for w, t in since.items() if now - t >= max_age]:
+                self._send(webhook_url, _coalesce(pending.pop(webhook_url)))
+                del since[webhook_url]
+
+    def _send(self, webhook_url: str, merged: List[Tuple[str, List[str]]]) -> None:
+        for content, site_ids in merged:
+            counters: Dict[str, int] = {}
+            ok = _deliver(webhook_url, content, counters)
+            with self._lock:
+                self.stats['posts'] += counters.get('posts', 0)
+                self.stats['rate_limited'] += counters.get('rate_limited', 0)
+                key = 'delivered' if ok else 'failed'
+                self.stats[key] += len(site_ids)
+                for site_id in site_ids:
+                    per_site = self.stats['sites'].setdefault(site_id, {'delivered': 0, 'failed': 0})
+                    per_site[key] += 1
+
+    def close(self, timeout: float | None = None) -> Dict[str, Any]:
+        """Stop after sending everything queued; returns delivery stats."""
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        with self._lock:
+            stats = dict(self.stats)
+            stats['sites'] = {k: dict(v) for k, v in self.stats['sites'].items()}
+        stats['pending'] = stats['queued'] - stats['delivered'] - stats['failed']
+        return stats
+
+
+_RUN_QUEUE: NotificationQueue | None = None
+_RUN_QUEUE_LOCK = threading.Lock()
+
+
+def start_run_queue() -> NotificationQueue:
+    global _RUN_QUEUE
+    with _RUN_QUEUE_LOCK:
+        if _RUN_QUEUE is None:
+            _RUN_QUEUE = NotificationQueue()
+        return _RUN_QUEUE
+
+
+def close_run_queue(timeout: float | None = None) -> Dict[str, Any]:
+    """Flush and detach the run queue; later messages are posted directly."""
+    global _RUN_QUEUE
+    with _RUN_QUEUE_LOCK:
+        q, _RUN_QUEUE = _RUN_QUEUE, None
+    if q is None:
+        return {}
+    return q.close(_env_float('NOTIFY_FLUSH_TIMEOUT', 120) if timeout is None else timeout)
+
+
+def _post(webhook_url: str, content: str, site_id: str) -> None:
+    q = _RUN_QUEUE
+    if q is not None:
+        q.put(webhook_url, content, site_id)
+    else:
+        _deliver(webhook_url, content)
@@ -0,0 +1,69 @@
+from __future__ import annotations
+import contextvars
+import io
+import sys
+import threading
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+# Output of a site running on a worker thread is collected into its own buffer
+# and written out in one block when the site finishes, so parallel sites don't
+# interleave their log lines. The active buffer lives in a context variable;
+# helpers that fan out further (hooks) submit work through `submit` so their
+# prints land in the same buffer.
+_BUFFER: contextvars.ContextVar[io.StringIO | None] = contextvars.ContextVar('holo_log_buffer', default=None)
+_INSTALL_LOCK = threading.Lock()
+_EMIT_LOCK = threading.Lock()
+
+
+class _RoutingStream(io.TextIOBase):
+    def __init__(self, base):
+        self._base = base
+
+    def write(self, s: str) -> int:
+        buf = _BUFFER.get()
+        if buf is not None:
+            return buf.write(s)
+        return self._base.write(s)
+
+    def flush(self) -> None:
+        if _BUFFER.get() is None:
+            self._base.flush()
+
+    @property
+    def encoding(self):  # type: ignore[override]
+        return getattr(self._base, 'encoding', 'utf-8')
+
+    def isatty(self) -> bool:
+        return bool(getattr(self._base, 'isatty', lambda: False)())
+
+
+def _install() -> _RoutingStream:
+    with _INSTALL_LOCK:
+        if not isinstance(sys.stdout, _RoutingStream):
+            sys.stdout = _RoutingStream(sys.stdout)
+        return sys.stdout  # type: ignore[return-value]
+
+
+@contextmanager
+def captured_output() -> Iterator[io.StringIO]:
+    """Route prints from this context into a private buffer, emitted on exit."""
+    stream = _install()
+    buf = io.StringIO()
+    token = _BUFFER.set(buf)
+    try:
+        yield buf
+    finally:
+        _BUFFER.reset(token)
+        text = buf.getvalue()
+        if text:
+            with _EMIT_LOCK:
+                stream._base.write(text)
+                stream._base.flush()
+
+
+def submit(executor: Executor, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+    """executor.submit that carries the caller's context (and log buffer) along."""
+    ctx = contextvars.copy_context()
+    return executor.submit(ctx.run, fn, *args, **kwargs)
@@ -0,0 +1,116 @@
+from __future__ import annotations
+import json
+import os
+import sys
+from typing import Any, Dict, List
+
+from bs4 import BeautifulSoup
+
+# Pluggable HTML parser layer for every extractor/scraper.
+#
+# All call sites keep using BeautifulSoup + soupsieve CSS selectors, so
+# selector semantics are identical whichever tree builder is active; only the
+# tree construction changes. The default stays the pure-Python html.parser
+# until lxml's output has been checked against saved pages of every enabled
+# site (see the parity check below); HTML_PARSER=lxml opts in.
+
+_FALLBACK = 'html.parser'
+_BACKEND: str | None = None
+
+
+def _lxml_available() -> bool:
+    try:
+        import lxml  # type: ignore  # noqa: F401
+        return True
+    except Exception:
+        return False
+
+
+def parser_backend() -> str:
+    global _BACKEND
+    if _BACKEND is None:
+        _BACKEND = str(os.getenv('HTML_PARSER', '')).strip() or _FALLBACK
+    return _BACKEND
+
+
+def _candidate_backend() -> str:
+    """Backend to compare against html.parser: the configured one, else lxml if installed."""
+    backend = parser_backend()
+    if backend == _FALLBACK and _lxml_available():
+        return 'lxml'
+    return backend
+
+
+def make_soup(markup: str | bytes, backend: str | None = None) -> BeautifulSoup:
+    return BeautifulSoup(markup, backend or parser_backend())
+
+
+# ======================== parity check ========================
+# python -m holo_monitor.parsing <saved.html> --url <page url> [--site <id>]
+#
+# Runs the same extraction on a saved page with html.parser and with the
+# candidate fast backend (HTML_PARSER, or lxml) and reports any difference. With --site the listing
+# extractor configured for that site in sites.yaml is used; otherwise the
+# detail scraper chosen by the URL's host.
+
+def _extract_with(backend: str, html: str, url: str, site: Dict[str, Any] | None) -> Any:
+    global _BACKEND
+    prev = _BACKEND
+    _BACKEND = backend
+    try:
+        if site is not None:
+            from .runner import extract_items
+            return extract_items(site, html, url)
+        from .detail_scrapers import parse_detail
+        return parse_detail(url, html)
+    finally:
+        _BACKEND = prev
+
+
+def compare_backends(html: str, url: str, site: Dict[str, Any] | None = None,
+                     backends: List[str] | None = None) -> Dict[str, Any]:
+    names = backends or [_FALLBACK, _candidate_backend()]
+    outputs = {name: _extract_with(name, html, url, site) for name in names}
+    base_name = names[0]
+    base = json.dumps(outputs[base_name], ensure_ascii=False, sort_keys=True)
+    mismatched = [n for n in names[1:] if json.dumps(outputs[n], ensure_ascii=False, sort_keys=True) != base]
+    return {'backends': names, 'mismatched': mismatched, 'outputs': outputs}
+
+
+def _main(argv: List[str]) -> int:
+    import argparse
+    ap = argparse.ArgumentParser(prog='python -m holo_monitor.parsing', description='Compare extraction output across HTML parser backends.')
+    ap.add_argument('paths', nargs='+', help='saved HTML files')
+    ap.add_argument('--url', required=True, help='original page URL (selects scraper and resolves links)')
+    ap.add_argument('--site', help='site id from sites.yaml to run the listing extractor instead of the detail scraper')
+    ap.add_argument('--backend', action='append', help='backend to compare (repeatable; default: html.parser and lxml)')
+    args = ap.parse_args(argv)
+
+    site = None
+    if args.site:
+        from .runner import load_yaml
+        cfg_path = os.environ.get('SITES_YAML', os.path.join(os.path.dirname(__file__), 'sites.yaml'))
+        sites = (load_yaml(cfg_path).get('sites') or [])
+        site = next((s for s in sites if str(s.get('id')) == args.site), None)
+        if site is None:
+            print(f"[parsing] site '{args.site}' not found in {cfg_path}", flush=True)
+            return 2
+
+    failed = 0
+    for path in args.paths:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            html = f.read()
+        result = compare_backends(html, args.url, site, args.backend)
+        if result['mismatched']:
+            failed += 1
+            print(f"[parsing] MISMATCH {path}: {', '.join(result['mismatched'])} differ from {result['backends'][0]}", flush=True)
+            for name in result['backends']:
+                print(f"--- {name}", flush=True)
+                print(json.dumps(result['outputs'][name], ensure_ascii=False, indent=2, sort_keys=True), flush=True)
+        else:
+            print(f"[parsing] OK {path} ({' == '.join(result['backends'])})", flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
@@ -1,13 +1,20 @@
 from __future__ import annotations
-import os, json, re, sys
-from typing import List, Dict, Any
+import os, json, hashlib, re, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Collection, List, Dict, Any, Tuple
 from urllib.parse import urljoin, urlparse, parse_qs
 
-import requests
-from bs4 import BeautifulSoup
+import soupsieve
 import yaml
 
-from . import notify, hooks
+from . import notify, hooks, http_cache, parallel, scheduler, state_store
+from .parsing import make_soup
+from .http_client import (
+    NotModified, check_unchanged, commit_validators, conditional_enabled, conditional_headers,
+    close_session, ensure_host_warm, get_session, register_site_warmups, set_engine, throttle, warm_up,
+)
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0 Safari/537.36",
@@ -38,50 +45,19 @@ def load_yaml(path: str) -> Dict[str, Any]:
     with open(path, "r", encoding="utf-8") as f:
         return yaml.safe_load(f) or {}
 
-def load_state(path: str) -> tuple[set[str], str]:
-    if not os.path.exists(path):
-        return set(), ""
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if isinstance(data, dict):
-            ids = set(data.get("ids", []) or data.get("gcodes", []))
-            head_id = str(data.get("head_id", "") or "").strip()
-            return ids, head_id
-    except Exception:
-        pass
-    return set(), ""
-
-
 def _item_id(item: Dict[str, Any]) -> str:
     return str(item.get("id") or item.get("gcode") or "").strip()
 
 
-def _take_until_head(items: List[Dict[str, Any]], prev_head_id: str) -> List[Dict[str, Any]]:
-    if not prev_head_id:
-        return items
-    out: List[Dict[str, Any]] = []
-    for it in items:
-        if _item_id(it) == prev_head_id:
-            break
-        out.append(it)
-    return out
-
+# Responses from prefetch_pages keyed by (url, conditional), consumed by fetch_html
+_PREFETCHED: Dict[Tuple[str, bool], Any] = {}
+_PREFETCH_LOCK = threading.Lock()
 
-def save_state(path: str, ids: set, head_id: str) -> None:
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump({"ids": sorted(ids), "head_id": head_id}, f, ensure_ascii=False, indent=2)
 
-
-
-def fetch_html(url: str) -> str:
-    s = requests.Session()
-    # warm-up: hit top to set cookies
-    try:
-        s.get("https://www.amiami.jp/", headers=HEADERS, timeout=30)
-    except Exception:
-        pass
+def _request_headers(url: str, conditional: bool) -> Tuple[Dict[str, str], str, str]:
+    """Headers for the first GET of `url` (running its host warm-ups); returns (headers, host, path)."""
+    # warm-up: hit the host's registered top page once per run to set cookies
+    warmups = ensure_host_warm(url, headers=HEADERS)
 
     h2 = dict(HEADERS)
 
@@ -96,10 +72,9 @@ def fetch_html(url: str) -> str:
     if host.endswith('amiami.jp') and '/top/detail/detail' in path:
         # Simulate navigation from slist (same-site) and include modern fetch/client-hints headers
         slist_referer = "https://slist.amiami.jp/top/search/list?s_sortkey=regtimed&pagemax=60"
-        try:
-            s.get("https://slist.amiami.jp/top/search/list?s_sortkey=regtimed&pagemax=60", headers=HEADERS, timeout=30)
-        except Exception:
-            pass
+        if not warmups:
+            warm_up("https://www.amiami.jp/", headers=HEADERS)
+        warm_up(slist_referer, headers=HEADERS)
         h2.update({
             "Referer": slist_referer,
             # Typical modern Chromium client hints / fetch headers for top-level navigation
@@ -114,16 +89,69 @@ def fetch_html(url: str) -> str:
             "DNT": "1",
         })
     else:
-        # Default referer behavior (previous behavior)
-        h2["Referer"] = "https://www.amiami.jp/"
+        # Refer from the host's own warm-up page when one is declared
+        h2["Referer"] = warmups[0] if warmups else "https://www.amiami.jp/"
+
+    if conditional:
+        h2.update(conditional_headers(url))
+    return h2, host, path
+
+
+def prefetch_pages(pages: List[Tuple[str, bool]]) -> int:
+    """GET many pages in one batch on the async engine's event loop.
 
-    resp = s.get(url, headers=h2, timeout=30, allow_redirects=True)
+    Responses are handed to the next fetch_html(url, conditional) call for
+    the same pair, which still runs the 403/slist/impersonation fallbacks.
+    Does nothing unless the async engine is active; returns the number of
+    pages prefetched.
+    """
+    gather = getattr(get_session(), "gather", None)
+    if gather is None or not pages:
+        return 0
+    calls = []
+    for url, conditional in pages:
+        h2 = _request_headers(url, conditional)[0]
+        throttle(url)
+        calls.append(("GET", url, {"headers": h2, "timeout": 30, "allow_redirects": True}))
+    results = gather(calls)
+    done = 0
+    with _PREFETCH_LOCK:
+        for key, resp in zip(pages, results):
+            if not isinstance(resp, BaseException):
+                _PREFETCHED[key] = resp
+                done += 1
+    return done
+
+
+def fetch_html(url: str, conditional: bool = False, use_cache: bool = False) -> str:
+    """Fetch a page as text.
+
+    With conditional=True the stored ETag/Last-Modified are sent and
+    NotModified is raised on a 304 or when the body hash matches the last
+    processed one; commit_validators(url) records the new validators.
+    With use_cache=True a fresh entry in the on-disk http_cache is returned
+    without touching the network, and successful fetches are stored there.
+    A response prefetched by prefetch_pages is used for the first request.
+    """
+    if use_cache:
+        cached = http_cache.get(url)
+        if cached is not None:
+            return cached.text
+    s = get_session()
+    h2, host, path = _request_headers(url, conditional)
+
+    with _PREFETCH_LOCK:
+        resp = _PREFETCHED.pop((url, conditional), None)
+    if resp is None:
+        throttle(url)
+        resp = s.get(url, headers=h2, timeout=30, allow_redirects=True)
     if resp.status_code in (403, 503):
         # retry once with minor header tweaks
         h2["User-Agent"] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
         h2["Cache-Control"] = "no-cache"
         h2.setdefault("Pragma", "no-cache")
         try:
+            throttle(url)
             resp = s.get(url, headers=h2, timeout=30, allow_redirects=True)
         except Exception:
             pass
@@ -135,6 +163,7 @@ def fetch_html(url: str) -> str:
             h_slist = dict(h2)
             # When hitting slist directly, keep slist referer
             h_slist["Referer"] = "https://slist.amiami.jp/"
+            throttle(slist_url)
             alt = s.get(slist_url, headers=h_slist, timeout=30, allow_redirects=True)
             if alt.ok:
                 resp = alt
@@ -148,87 +177,203 @@ def fetch_html(url: str) -> str:
             cr_headers = dict(h2)
             for imp in ("chrome124", "chrome120"):
                 try:
+                    throttle(url)
                     alt = curl_requests.get(url, headers=cr_headers, impersonate=imp, timeout=30)
                     if alt.status_code == 200 and (alt.text or "").strip():
+                        if use_cache:
+                            http_cache.put(url, 200, {"Content-Type": "text/html; charset=utf-8"}, alt.text.encode("utf-8"), "utf-8")
                         return alt.text
                 except Exception:
                     continue
         except Exception:
             pass
 
+    if conditional:
+        check_unchanged(url, resp)
     resp.raise_for_status()
-    return resp.text
-
-def extract_amiami(html: str, base_url: str) -> List[Dict[str, str]]:
-    soup = BeautifulSoup(html, "html.parser")
+    text = resp.text
+    if use_cache:
+        http_cache.put(url, resp.status_code, resp.headers, resp.content, resp.encoding)
+    return text
+
+def extract_amiami(html: str, base_url: str, stop_ids: Collection[str] | None = None, limit: int = 0,
+                   tail: List[Dict[str, str]] | None = None) -> List[Dict[str, str]]:
+    soup = make_soup(html)
     items: List[Dict[str, str]] = []
-    for a in soup.select('a[href*="detail?gcode="]'):
+    stopped = False
+    for a in soup.css.iselect('a[href*="detail?gcode="]'):
         href = a.get("href", "")
         full_url = urljoin(base_url, href)
         q = parse_qs(urlparse(full_url).query)
         gcode = (q.get("gcode", [""])[0] or "").strip()
         if not gcode:
             continue
+        if not stopped and stop_ids and gcode in stop_ids:
+            if tail is None:
+                break
+            stopped = True
         name_el = a.select_one(".product_name_inner")
         title = normalize_text(name_el.get_text()) if name_el else ""
         price_el = a.select_one(".product_price")
         price = normalize_text(price_el.get_text()) if price_el else ""
-        items.append({"id": gcode, "gcode": gcode, "title": title, "url": full_url, "price": price})
+        (tail if stopped else items).append({"id": gcode, "gcode": gcode, "title": title, "url": full_url, "price": price})
+        if limit and len(items) + (len(tail) if stopped else 0) >= limit:
+            break
     return items
 
-def extract_generic(html: str, base_url: str, selectors: Dict[str, Any]) -> List[Dict[str, str]]:
-    soup = BeautifulSoup(html, "html.parser")
+@dataclass(frozen=True)
+class GenericPlan:
+    """Compiled form of a generic site's `selectors` block."""
+    item: soupsieve.SoupSieve
+    link: soupsieve.SoupSieve | None
+    title: soupsieve.SoupSieve | None
+    price: soupsieve.SoupSieve | None
+    id_type: str
+    id_param: str = ""
+    id_regex: re.Pattern | None = None
+    id_has_group: bool = False
+
+
+_PLAN_CACHE: Dict[str, GenericPlan] = {}
+
+
+def _compile_css(selectors: Dict[str, Any], key: str, required: bool = False) -> soupsieve.SoupSieve | None:
+    sel = selectors.get(key)
+    if not sel:
+        if required:
+            raise ValueError(f"selectors.{key} is required")
+        return None
+    if not isinstance(sel, str):
+        raise ValueError(f"selectors.{key} must be a CSS selector string")
+    try:
+        return soupsieve.compile(sel)
+    except Exception as exc:
+        raise ValueError(f"selectors.{key} is not a valid CSS selector ({sel!r}): {exc}") from exc
+
+
+def compile_selectors(selectors: Dict[str, Any]) -> GenericPlan:
+    """Validate and compile a generic `selectors` config; raises ValueError."""
+    if not isinstance(selectors, dict):
+        raise ValueError("selectors must be a mapping")
+    item = _compile_css(selectors, "item", required=True)
+    link = _compile_css(selectors, "link")
+    title = _compile_css(selectors, "title")
+    price = _compile_css(selectors, "price")
+    id_conf = selectors.get("id", {}) or {}
+    if not isinstance(id_conf, dict):
+        raise ValueError("selectors.id must be a mapping")
+    mtype = id_conf.get("type", "query_param")
+    id_param = ""
+    id_regex = None
+    if mtype == "query_param":
+        id_param = str(id_conf.get("param") or "").strip()
+        if not id_param:
+            raise ValueError("selectors.id.param is required for type 'query_param'")
+    elif mtype == "regex":
+        pat = id_conf.get("pattern")
+        if not pat:
+            raise ValueError("selectors.id.pattern is required for type 'regex'")
+        try:
+            id_regex = re.compile(pat)
+        except re.error as exc:
+            raise ValueError(f"selectors.id.pattern is not a valid regex ({pat!r}): {exc}") from exc
+    else:
+        raise ValueError(f"selectors.id.type must be 'query_param' or 'regex' (got {mtype!r})")
+    return GenericPlan(
+        item=item,
+        link=link,
+        title=title,
+        price=price,
+        id_type=mtype,
+        id_param=id_param,
+        id_regex=id_regex,
+        id_has_group=bool(id_regex is not None and id_regex.groups),
+    )
+
+
+def get_plan(selectors: Dict[str, Any]) -> GenericPlan:
+    key = json.dumps(selectors, sort_keys=True, ensure_ascii=False, default=str)
+    plan = _PLAN_CACHE.get(key)
+    if plan is None:
+        plan = compile_selectors(selectors)
+        _PLAN_CACHE[key] = plan
+    return plan
+
+
+def validate_sites(sites: List[Dict[str, Any]]) -> None:
+    """Check every site config up front (parser name, generic selectors).
+
+    Raises ValueError naming the first broken site so a typo in sites.yaml
+    stops the run before any page is fetched.
+    """
+    for index, site in enumerate(sites, 1):
+        site_id = str(site.get("id", "")) or f"site_{index}"
+        parser = site.get("parser", "amiami")
+        if parser not in PARSERS:
+            raise ValueError(f"{site_id}: unknown parser '{parser}'")
+        if parser == "generic":
+            try:
+                get_plan(site.get("selectors", {}) or {})
+            except ValueError as exc:
+                raise ValueError(f"{site_id}: {exc}") from exc
+
+
+def extract_generic(html: str, base_url: str, selectors: Dict[str, Any] | GenericPlan,
+                    stop_ids: Collection[str] | None = None, limit: int = 0,
+                    tail: List[Dict[str, str]] | None = None) -> List[Dict[str, str]]:
+    plan = selectors if isinstance(selectors, GenericPlan) else get_plan(selectors)
+    soup = make_soup(html)
     items: List[Dict[str, str]] = []
-    item_sel = selectors.get("item")
-    link_sel = selectors.get("link")
-    title_sel = selectors.get("title")
-    price_sel = selectors.get("price")
-    id_conf = selectors.get("id", {})
-
-    for node in soup.select(item_sel):
-        link_node = node.select_one(link_sel) if link_sel else node
+    stopped = False
+
+    # iselect walks the tree lazily, so breaking out below skips the rest
+    for node in plan.item.iselect(soup):
+        link_node = plan.link.select_one(node) if plan.link else node
         href = link_node.get("href") if link_node else None
         if not href:
             continue
         full_url = urljoin(base_url, href)
+        pid = None
+        if plan.id_type == "query_param":
+            q = parse_qs(urlparse(full_url).query)
+            pid = (q.get(plan.id_param, [""])[0] or "").strip()
+        else:
+            m = plan.id_regex.search(full_url)
+            if m:
+                pid = m.group(1) if plan.id_has_group else m.group(0)
+        if not pid:
+            continue
+        if not stopped and stop_ids and pid in stop_ids:
+            if tail is None:
+                break
+            stopped = True
         title = ""
-        if title_sel:
-            tnode = node.select_one(title_sel)
+        if plan.title:
+            tnode = plan.title.select_one(node)
             title = normalize_text(tnode.get_text()) if tnode else ""
         price = ""
-        if price_sel:
-            pnode = node.select_one(price_sel)
+        if plan.price:
+            pnode = plan.price.select_one(node)
             price = normalize_text(pnode.get_text()) if pnode else ""
-        pid = None
-        mtype = id_conf.get("type", "query_param")
-        if mtype == "query_param":
-            param = id_conf.get("param")
-            if param:
-                q = parse_qs(urlparse(full_url).query)
-                pid = (q.get(param, [""])[0] or "").strip()
-        elif mtype == "regex":
-            pat = id_conf.get("pattern")
-            if pat:
-                m = re.search(pat, full_url)
-                if m:
-                    pid = m.group(1) if m.groups() else m.group(0)
-        if not pid:
-            continue
-        items.append({"id": pid, "title": title, "url": full_url, "price": price})
+        (tail if stopped else items).append({"id": pid, "title": title, "url": full_url, "price": price})
+        if limit and len(items) + (len(tail) if stopped else 0) >= limit:
+            break
     return items
 
 
-def extract_bandai_candy(html: str, base_url: str) -> List[Dict[str, str]]:
+def extract_bandai_candy(html: str, base_url: str, stop_ids: Collection[str] | None = None, limit: int = 0,
+                         tail: List[Dict[str, str]] | None = None) -> List[Dict[str, str]]:
     """Extract latest product links from Bandai Candy top page.
     The page contains various sections (slider, blocks) linking to
     /candy/products/YYYY/ID.html. We collect unique product URLs and
     derive IDs from the numeric part before .html.
     Title/price are omitted here (detail fetch will populate them).
     """
-    soup = BeautifulSoup(html, "html.parser")
+    soup = make_soup(html)
     items: List[Dict[str, str]] = []
     seen: set[str] = set()
-    for a in soup.select('a[href*="/candy/products/"]'):
+    stopped = False
+    for a in soup.css.iselect('a[href*="/candy/products/"]'):
         href = a.get("href") or ""
         if not href:
             continue
@@ -241,6 +386,10 @@ def extract_bandai_candy(html: str, base_url: str) -> List[Dict[str, str]]:
         if pid in seen:
             continue
         seen.add(pid)
+        if not stopped and stop_ids and pid in stop_ids:
+            if tail is None:
+                break
+            stopped = True
         title = ""
         try:
             # Prefer visible text near the link if present
@@ -251,7 +400,9 @@ def extract_bandai_candy(html: str, base_url: str) -> List[Dict[str, str]]:
                     title = normalize_text(img.get('alt'))
         except Exception:
             pass
-        items.append({"id": pid, "title": title, "url": full_url, "price": ""})
+        (tail if stopped else items).append({"id": pid, "title": title, "url": full_url, "price": ""})
+        if limit and len(items) + (len(tail) if stopped else 0) >= limit:
+            break
     return items
 
 
@@ -265,7 +416,9 @@ def _normalize_shopify_price(value: str) -> str:
     return digits or stripped
 
 
-def extract_shopify_products(raw: str, source_url: str, options: Dict[str, Any]) -> List[Dict[str, str]]:
+def extract_shopify_products(raw: str, source_url: str, options: Dict[str, Any],
+                             stop_ids: Collection[str] | None = None, limit: int = 0,
+                             tail: List[Dict[str, str]] | None = None) -> List[Dict[str, str]]:
     try:
         data = json.loads(raw)
     except Exception:
@@ -286,6 +439,7 @@ def extract_shopify_products(raw: str, source_url: str, options: Dict[str, Any])
     except Exception:
         pass
     items: List[Dict[str, str]] = []
+    stopped = False
     for prod in products:
         handle = prod.get('handle') or ''
         title = normalize_text(prod.get('title') or '')
@@ -297,6 +451,10 @@ def extract_shopify_products(raw: str, source_url: str, options: Dict[str, Any])
         if not product_url:
             continue
         pid = str(prod.get('id') or handle or product_url).strip()
+        if not stopped and stop_ids and pid in stop_ids:
+            if tail is None:
+                break
+            stopped = True
         price = ''
         variants = prod.get('variants') or []
         for variant in variants:
@@ -308,11 +466,85 @@ def extract_shopify_products(raw: str, source_url: str, options: Dict[str, Any])
             pv = variants[0].get('price')
             if pv:
                 price = _normalize_shopify_price(pv)
-        items.append({'id': pid, 'title': title, 'url': product_url, 'price': price})
+        (tail if stopped else items).append({'id': pid, 'title': title, 'url': product_url, 'price': price})
+        if limit and len(items) + (len(tail) if stopped else 0) >= limit:
+            break
     return items
 
 
-def run_site(site: Dict[str, Any], discord_env_url: str | None) -> None:
+PARSERS = ("amiami", "generic", "shopify", "bandai_candy")
+
+
+def extract_items(site: Dict[str, Any], html: str, url: str,
+                  stop_ids: Collection[str] | None = None, limit: int = 0,
+                  tail: List[Dict[str, str]] | None = None) -> List[Dict[str, str]]:
+    """Run the site's listing extractor.
+
+    Extraction stops (exclusive) at the first item whose id is in `stop_ids`
+    and after `limit` items, so callers that only need the part of the page
+    above the previous head don't pay for the rest of it. When `tail` is
+    given, the items from the stop point on are appended to it instead
+    (still within `limit` items in total).
+    """
+    parser = site.get("parser", "amiami")
+    if parser == "amiami":
+        return extract_amiami(html, url, stop_ids, limit, tail)
+    if parser == "generic":
+        return extract_generic(html, url, site.get("selectors", {}), stop_ids, limit, tail)
+    if parser == "shopify":
+        return extract_shopify_products(html, url, site.get("parser_options", {}), stop_ids, limit, tail)
+    if parser == "bandai_candy":
+        return extract_bandai_candy(html, url, stop_ids, limit, tail)
+    return []
+
+
+class AnchorSet(set):
+    """stop_ids for extract_items that remembers which anchor ended the walk."""
+
+    def __init__(self, anchors: List[str]):
+        super().__init__(a for a in anchors if a)
+        self.matched = ""
+
+    def __contains__(self, item: object) -> bool:
+        hit = set.__contains__(self, item)
+        if hit and not self.matched:
+            self.matched = str(item)
+        return hit
+
+
+def _anchor_count(site: Dict[str, Any]) -> int:
+    try:
+        return max(1, int(site.get("head_anchors", 5)))
+    except (TypeError, ValueError):
+        return 5
+
+
+def listing_fingerprint(item: Dict[str, Any]) -> str:
+    """Cheap hash of what the listing shows for an item (title + price)."""
+    title = normalize_text(str(item.get("title") or ""))
+    price = normalize_text(str(item.get("price") or ""))
+    if not title and not price:
+        return ""
+    return hashlib.blake2b(f"{title}\x1f{price}".encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _track_updates(site: Dict[str, Any]) -> bool:
+    return str(site.get("track_updates", "")).strip().lower() in ("1", "true", "yes", "on")
+
+
+def next_anchors(walked: List[str], prev: List[str], matched: str, k: int) -> List[str]:
+    """Top-k anchors after a walk: the walked ids, then the old anchors from the one that matched."""
+    tail = prev[prev.index(matched):] if matched in prev else prev
+    out: List[str] = []
+    for x in walked + tail:
+        if x and x not in out:
+            out.append(x)
+        if len(out) >= k:
+            break
+    return out
+
+
+def run_site(site: Dict[str, Any], discord_env_url: str | None) -> Dict[str, Any]:
     site_id = str(site.get("id", "site") or "site")
     url = site.get("monitor_url")
     parser = site.get("parser", "amiami")
@@ -320,34 +552,67 @@ def run_site(site: Dict[str, Any], discord_env_url: str | None) -> None:
     keywords = site.get("keywords", [])
     state_file = site.get("state_file", f"state/{site.get('id','site')}.json")
     webhook = site.get("discord_webhook") or discord_env_url
+    summary: Dict[str, Any] = {"site": site_id, "status": "ok", "items": 0, "new": 0, "updated": 0, "wrote": 0, "errors": 0, "backlog": 0}
 
     if not url:
         _log(site_id, "monitor_url not configured; skipping site")
-        return
+        summary["status"] = "skipped"
+        return summary
+
+    store = state_store.get_store()
+    if store.ensure_migrated(site_id, state_file):
+        _log(site_id, f"Imported legacy state from {state_file} into {store.path}")
+
+    # Pending backlog still has to be drained, so only skip unchanged pages
+    # when there is nothing carried over.
+    # Marked so hooks fetch their detail pages fresh instead of from http_cache
+    backlog = [dict(it, from_backlog=True) for it in store.load_backlog(site_id)]
+    conditional = conditional_enabled() and not backlog
 
     _log(site_id, f"Fetching monitor URL: {url}")
     try:
-        html = fetch_html(url)
+        html = fetch_html(url, conditional=conditional)
+    except NotModified as nm:
+        _log(site_id, f"Monitor page unchanged ({nm.reason}); skipping parse and state write")
+        summary["status"] = "unchanged"
+        return summary
     except Exception as e:
         _log(site_id, f"[ERROR] fetch_html failed for {url}: {e}")
-        return
+        summary["status"] = "fetch_error"
+        summary["errors"] = 1
+        return summary
     _log(site_id, "Fetch succeeded")
 
-    if parser == "amiami":
-        items = extract_amiami(html, url)
-    elif parser == "generic":
-        items = extract_generic(html, url, site.get("selectors", {}))
-    elif parser == "shopify":
-        items = extract_shopify_products(html, url, site.get("parser_options", {}))
-    elif parser == "bandai_candy":
-        items = extract_bandai_candy(html, url)
+    prev_fps, prev_anchors = store.load_fingerprints(site_id), store.anchors(site_id)
+    prev = set(prev_fps)
+    track_updates = _track_updates(site)
+    _log(site_id, f"Loaded {len(prev)} previous id(s) from state (anchors={len(prev_anchors)}, track_updates={track_updates})")
+
+    # Walk the listing only down to the first of the previous top ids still
+    # on the page (and at most top_n items); everything below it was
+    # already seen. Several anchors keep the cutoff working when the single
+    # top item is delisted or moved; sites tracking updates skip the cutoff.
+    # Items below it are still read (within top_n) so known items that are
+    # still listed don't age out and their title/price can be compared.
+    stop_ids = AnchorSet([] if track_updates else prev_anchors)
+    below: List[Dict[str, str]] = []
+    if parser in PARSERS:
+        items = extract_items(site, html, url, stop_ids=stop_ids, limit=top_n, tail=below)
     else:
         _log(site_id, f"Unknown parser '{parser}'; defaulting to no items")
         items = []
 
-    _log(site_id, f"Parser '{parser}' produced {len(items)} item(s)")
-    items = items[:top_n]
-    _log(site_id, f"Trimmed to {len(items)} item(s) (top_n={top_n})")
+    _log(site_id, (
+        f"Parser '{parser}' produced {len(items)} item(s) (top_n={top_n}, stopped at={stop_ids.matched or '-'}, "
+        f"listed below={len(below)})"
+    ))
+    if stop_ids and not stop_ids.matched:
+        _log(site_id, (
+            f"[WARN] None of the {len(prev_anchors)} previous anchor(s) matched within {len(items)} item(s); "
+            "listing may have been reshuffled, treating the whole window as candidates"
+        ))
+    elif stop_ids.matched and stop_ids.matched != prev_anchors[0]:
+        _log(site_id, f"Head anchor {prev_anchors[0]} not found; cut off at anchor #{prev_anchors.index(stop_ids.matched) + 1}")
 
     if keywords:
         filtered = [it for it in items if title_match(it.get("title", ""), keywords)]
@@ -356,36 +621,62 @@ def run_site(site: Dict[str, Any], discord_env_url: str | None) -> None:
         filtered = items
         _log(site_id, f"No keywords configured; using {len(filtered)} item(s)")
 
-    prev, prev_head_id = load_state(state_file)
-    _log(site_id, f"Loaded {len(prev)} previous id(s) from state (head_id={prev_head_id or '-'})")
-
-    window = _take_until_head(filtered, prev_head_id)
-    if prev_head_id:
-        _log(site_id, f"Head cutoff applied: {len(window)} item(s) before previous head")
-
-    current = {_item_id(it) for it in filtered}
-    current = {x for x in current if x}
-    new_ids = current - prev
+    window = filtered
+    window_ids = {x for x in (_item_id(it) for it in window) if x}
+    # Everything below the cutoff was seen before; the store keeps the
+    # previous set and the window is upserted on top of it. Known items
+    # still listed below the cutoff get their last_seen refreshed with it.
+    listed = [it for it in below if _item_id(it) in prev]
+    still_listed = {_item_id(it) for it in listed}
+    if keywords:
+        listed = [it for it in listed if title_match(it.get("title", ""), keywords)]
+    current = prev | window_ids
+    new_ids = window_ids - prev
     new_items = [it for it in window if _item_id(it) in new_ids]
-    _log(site_id, f"Current set size: {len(current)}; new items detected: {len(new_items)}")
-    new_head_id = _item_id(filtered[0]) if filtered else prev_head_id
-
-    if new_items and webhook:
-        _log(site_id, f"Sending Discord summary for {len(new_items)} new item(s)")
+    fingerprints = {_item_id(it): listing_fingerprint(it) for it in window + listed if _item_id(it)}
+    # Known items whose listing title/price changed, in the window or
+    # below the cutoff. Ids without a stored fingerprint (first run after
+    # upgrading) only get one recorded.
+    updated_items = [
+        dict(it, ChangeType="updated") for it in window + listed
+        if _item_id(it) in prev and prev_fps[_item_id(it)] and fingerprints[_item_id(it)]
+        and prev_fps[_item_id(it)] != fingerprints[_item_id(it)]
+    ]
+    _log(site_id, f"Current set size: {len(current)}; new items detected: {len(new_items)}, updated: {len(updated_items)}")
+    summary["items"] = len(filtered)
+    summary["new"] = len(new_items)
+    summary["updated"] = len(updated_items)
+    changed_items = new_items + updated_items
+    anchors = next_anchors([_item_id(it) for it in items], prev_anchors, stop_ids.matched, _anchor_count(site))
+    new_head_id = anchors[0] if anchors else ""
+
+    batch_limit = scheduler.detail_batch_limit(site)
+    batch, overflow = scheduler.plan_detail_batch(backlog, changed_items, batch_limit)
+    if backlog or overflow:
+        _log(site_id, (
+            f"Detail batch: {len(batch)} item(s) this run (limit={batch_limit or '-'}, "
+            f"backlog drained={min(len(backlog), len(batch))}, carried over={len(overflow)})"
+        ))
+    summary["backlog"] = len(overflow)
+
+    if changed_items and webhook:
+        _log(site_id, f"Sending Discord summary for {len(changed_items)} changed item(s)")
         try:
-            notify.send_discord_summary(webhook, site, new_items)
+            notify.send_discord_summary(webhook, site, changed_items)
         except Exception as exc:
             _log(site_id, f"[ERROR] Discord summary send failed: {exc}")
-    elif new_items:
-        _log(site_id, "New items found, but no webhook configured; skipping Discord summary")
+    elif changed_items:
+        _log(site_id, "Changed items found, but no webhook configured; skipping Discord summary")
     else:
-        _log(site_id, "No new items detected; skipping Discord summary")
+        _log(site_id, "No new or updated items detected; skipping Discord summary")
 
-    if new_items:
-        _log(site_id, f"Running hooks.on_change for {len(new_items)} item(s)")
+    if batch:
+        _log(site_id, f"Running hooks.on_change for {len(batch)} item(s)")
         try:
-            payloads, errors, wrote = hooks.on_change(site, new_items)
-            _log(site_id, f"hooks.on_change finished (wrote={wrote}, errors={len(errors)})")
+            payloads, errors, wrote = hooks.on_change(site, batch)
+            _log(site_id, f"hooks.on_change finished (payloads={len(payloads)}, wrote={wrote}, errors={len(errors)})")
+            summary["wrote"] = wrote
+            summary["errors"] = len(errors)
             if errors:
                 for err in errors[:3]:
                     _log(site_id, f"[HOOK ERROR] {err}")
@@ -398,15 +689,26 @@ def run_site(site: Dict[str, Any], discord_env_url: str | None) -> None:
                         _log(site_id, f"[ERROR] Discord error notification failed: {exc}")
         except Exception as exc:
             _log(site_id, f"[ERROR] hooks.on_change raised: {exc}")
+            summary["status"] = "hook_error"
+            summary["errors"] += 1
     else:
         _log(site_id, "Skipping hooks.on_change (no new items)")
 
     try:
-        save_state(state_file, current, new_head_id)
-        _log(site_id, f"State saved ({len(current)} id(s)) to {state_file}")
+        pruned = store.commit_run(
+            site_id, window_ids | still_listed, new_head_id, [scheduler.backlog_entry(it) for it in overflow],
+            retention=state_store.retention_for(site), anchors=anchors, fingerprints=fingerprints,
+        )
+        _log(site_id, f"State saved ({len(current) - pruned} id(s), pruned={pruned}, backlog={len(overflow)}) to {store.path}")
     except Exception as exc:
         _log(site_id, f"[ERROR] Failed to save state: {exc}")
         raise
+    if conditional:
+        try:
+            commit_validators(url)
+        except Exception as exc:
+            _log(site_id, f"[WARN] Failed to store HTTP validators: {exc}")
+    return summary
 
 def _cli_manual_url(argv: List[str]) -> str:
     if not argv:
@@ -420,6 +722,15 @@ def _cli_manual_url(argv: List[str]) -> str:
     return ''
 
 
+def _cli_engine(argv: List[str]) -> str:
+    for i, arg in enumerate(argv):
+        if arg == '--engine' and i + 1 < len(argv):
+            return str(argv[i + 1] or '').strip()
+        if arg.startswith('--engine='):
+            return arg.split('=', 1)[1].strip()
+    return ''
+
+
 def run_manual_url(url: str) -> None:
     manual_url = str(url or '').strip()
     if not manual_url:
@@ -428,7 +739,7 @@ def run_manual_url(url: str) -> None:
 
     _log('manual', f'Processing manual URL: {manual_url}')
     try:
-        _, errors, wrote = hooks.on_change({'id': 'manual'}, [{'id': 'manual', 'url': manual_url, 'title': '', 'price': ''}])
+        _, errors, wrote = hooks.on_change({'id': 'manual'}, [{'id': 'manual', 'url': manual_url, 'title': '', 'price': ''}], skip_unchanged=False)
         _log('manual', f'Manual processing finished (wrote={wrote}, errors={len(errors)})')
         if errors:
             for err in errors[:3]:
@@ -439,12 +750,137 @@ def run_manual_url(url: str) -> None:
         _log('manual', f'[ERROR] Manual URL processing failed: {exc}')
 
 
+def _monitor_fetches(sites: List[Dict[str, Any]]) -> List[Tuple[str, bool]]:
+    """(monitor_url, conditional) for every site, as run_site will fetch it."""
+    store = state_store.get_store()
+    fetches = []
+    for site in sites:
+        url = site.get("monitor_url")
+        if url:
+            site_id = str(site.get("id", "site") or "site")
+            fetches.append((url, conditional_enabled() and not store.load_backlog(site_id)))
+    return fetches
+
+
+def _site_concurrency(total: int) -> int:
+    try:
+        limit = int(os.environ.get("SITE_CONCURRENCY", "") or 4)
+    except ValueError:
+        limit = 4
+    return max(1, min(limit, total))
+
+
+def _run_site_captured(index: int, total: int, site: Dict[str, Any], discord_env_url: str | None, buffered: bool) -> Dict[str, Any]:
+    site_id = str(site.get("id", "")) or f"site_{index}"
+    started = time.monotonic()
+    with (parallel.captured_output() if buffered else nullcontext()):
+        _log(None, f"Processing site {index}/{total}: {site_id}")
+        try:
+            summary = run_site(site, discord_env_url)
+        except Exception as exc:
+            _log(site_id, f"[ERROR] run_site raised: {exc}")
+            summary = {"site": site_id, "status": "error", "items": 0, "new": 0, "updated": 0, "wrote": 0, "errors": 1, "exception": exc}
+    summary["elapsed"] = time.monotonic() - started
+    return summary
+
+
+def run_sites(sites: List[Dict[str, Any]], discord_env_url: str | None) -> List[Dict[str, Any]]:
+    """Run every site, up to SITE_CONCURRENCY at a time.
+
+    With more than one worker each site's log output is buffered and printed
+    as one block when the site finishes. Summaries keep configuration order.
+    """
+    total = len(sites)
+    workers = _site_concurrency(total)
+    _log(None, f"Running {total} site(s) with concurrency {workers}")
+    if workers <= 1:
+        return [_run_site_captured(i, total, site, discord_env_url, False) for i, site in enumerate(sites, 1)]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="site") as pool:
+        futures = [
+            parallel.submit(pool, _run_site_captured, i, total, site, discord_env_url, True)
+            for i, site in enumerate(sites, 1)
+        ]
+        return [f.result() for f in futures]
+
+
+def _commit_sheet_writes(sites: List[Dict[str, Any]], summaries: List[Dict[str, Any]], discord_env_url: str | None) -> None:
+    """Flush the run's buffered sheet rows and fold the outcome into each site's summary."""
+    results = hooks.flush_buffered_writes()
+    by_site = {s["site"]: s for s in summaries}
+    site_cfg = {str(site.get("id", "site") or "site"): site for site in sites}
+    for site_id, res in results.items():
+        if res.get("replayed"):
+            _log(site_id, f"Replayed {res['replayed']} queued sheet row(s) from an earlier run")
+        summary = by_site.get(site_id)
+        if summary is None:
+            if res["error"]:
+                _log(site_id, f"[ERROR] sheets: {res['error']} (queued rows kept for the next run)")
+            continue
+        summary["wrote"] = res["wrote"]
+        if not res["error"]:
+            continue
+        pending = res["queued"] - res["wrote"] - res.get("skipped", 0)
+        msg = f"sheets: {res['error']} ({pending} row(s) kept in queue for the next run)"
+        _log(site_id, f"[ERROR] {msg}")
+        summary["errors"] += 1
+        if summary["status"] == "ok":
+            summary["status"] = "sheet_error"
+        site = site_cfg.get(site_id) or {"id": site_id}
+        webhook = site.get("discord_webhook") or discord_env_url
+        if webhook:
+            try:
+                notify.send_discord_error(webhook, site, [msg])
+            except Exception as exc:
+                _log(site_id, f"[ERROR] Discord error notification failed: {exc}")
+
+
+def _log_run_summary(summaries: List[Dict[str, Any]], delivery: Dict[str, Any] | None = None) -> None:
+    delivery = delivery or {}
+    per_site = delivery.get("sites") or {}
+    _log(None, "Run summary:")
+    for s in summaries:
+        d = per_site.get(s["site"])
+        discord = f" discord={d['delivered']}/{d['delivered'] + d['failed']}" if d else ""
+        _log(None, (
+            f"  {s['site']}: status={s['status']} items={s['items']} new={s['new']} updated={s.get('updated', 0)} wrote={s['wrote']} "
+            f"errors={s['errors']} backlog={s.get('backlog', 0)}{discord} ({s.get('elapsed', 0.0):.1f}s)"
+        ))
+    _log(None, (
+        f"  total: sites={len(summaries)} new={sum(s['new'] for s in summaries)} updated={sum(s.get('updated', 0) for s in summaries)} "
+        f"wrote={sum(s['wrote'] for s in summaries)} errors={sum(s['errors'] for s in summaries)}"
+    ))
+    if delivery.get("queued"):
+        _log(None, (
+            f"  discord: delivered={delivery['delivered']} failed={delivery['failed']} pending={delivery['pending']} "
+            f"of {delivery['queued']} message(s) in {delivery['posts']} post(s), rate limited {delivery['rate_limited']}x"
+        ))
+
+
 def main() -> None:
     cfg_path = os.environ.get("SITES_YAML", os.path.join(os.path.dirname(__file__), "sites.yaml"))
     cfg = (load_yaml(cfg_path) if os.path.exists(cfg_path) else {"sites": []})
     sites = cfg.get("sites", []) or []
     _log(None, f"Loaded {len(sites)} site(s) from {cfg_path}")
+    try:
+        validate_sites(sites)
+    except ValueError as exc:
+        _log(None, f"[ERROR] Invalid site configuration in {cfg_path}: {exc}")
+        raise
+    for site in sites:
+        register_site_warmups(site)
+        http_cache.register_site_ttl(site)
+
+    engine = _cli_engine(sys.argv[1:])
+    if engine:
+        set_engine(engine)
+    try:
+        _run(sites)
+    finally:
+        close_session()
+        state_store.close_store()
+
 
+def _run(sites: List[Dict[str, Any]]) -> None:
     cli_url = _cli_manual_url(sys.argv[1:])
     if cli_url:
         _log(None, "CLI manual URL is set; running manual single-item mode")
@@ -464,15 +900,27 @@ def main() -> None:
         _log(None, "No global Discord webhook configured")
 
     total = len(sites)
-    for index, site in enumerate(sites, 1):
-        site_id = str(site.get("id", "")) or f"site_{index}"
-        _log(None, f"Processing site {index}/{total}: {site_id}")
-        run_site(site, discord_env_url)
-
     if total == 0:
         _log(None, "No sites configured; nothing to do")
-    else:
-        _log(None, "All sites processed")
+        return
+    # Discord messages are sent from a background queue while sites run;
+    # sheet rows from every site are written together once all sites finish
+    notify.start_run_queue()
+    hooks.begin_buffered_writes()
+    try:
+        # With the async engine every monitor page is requested in one batch up front
+        prefetched = prefetch_pages(_monitor_fetches(sites))
+        if prefetched:
+            _log(None, f"Prefetched {prefetched} monitor page(s) on the async engine")
+        summaries = run_sites(sites, discord_env_url)
+        _commit_sheet_writes(sites, summaries, discord_env_url)
+    finally:
+        delivery = notify.close_run_queue()
+    _log_run_summary(summaries, delivery)
+    _log(None, "All sites processed")
+    failed = [s for s in summaries if s.get("exception") is not None]
+    if failed:
+        raise failed[0]["exception"]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+from __future__ import annotations
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+
+class TokenBucket:
+    """Thread-safe token bucket.
+
+    `rate` tokens are added per second up to `capacity`. `acquire` reserves a
+    token (the balance may go negative) and sleeps until it is due, so
+    concurrent callers are spread out instead of all waking at once.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = max(float(rate), 1e-9)
+        self.capacity = max(float(capacity), 1.0)
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1.0
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def _item_key(item: Dict[str, Any]) -> str:
+    return str(item.get('id') or item.get('gcode') or item.get('url') or '').strip()
+
+
+def detail_batch_limit(site: Dict[str, Any]) -> int:
+    """Per-run cap on detail work from sites.yaml (0 or missing = unlimited)."""
+    try:
+        return max(0, int(site.get('detail_batch_limit') or 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def plan_detail_batch(backlog: List[Dict[str, Any]], new_items: List[Dict[str, Any]], limit: int) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Split pending work into (this run's batch, overflow for the backlog).
+
+    Backlog items carried from earlier runs are drained first, then newly
+    detected items in listing order. Duplicates (same id) are kept once.
+    """
+    queue: List[Dict[str, Any]] = []
+    seen: set[str] = set()
+    for item in list(backlog or []) + list(new_items or []):
+        key = _item_key(item)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        queue.append(item)
+    if limit <= 0:
+        return queue, []
+    return queue[:limit], queue[limit:]
+
+
+def backlog_entry(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Reduce an item to the JSON-safe fields worth persisting in state."""
+    keep = ('id', 'gcode', 'url', 'title', 'price', 'ChangeType')
+    return {k: item[k] for k in keep if item.get(k) not in (None, '')}
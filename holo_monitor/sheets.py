@@ -1,11 +1,18 @@
 from __future__ import annotations
+import hashlib
+import json
 import os
+import random
 import re
+import threading
+import time
 import unicodedata
 from typing import Dict, List, Tuple
 import gspread
+import requests
 from google.oauth2.service_account import Credentials
 from .creds import ensure_gcp_credentials_path
+from . import state_store
 
 
 SHEET_HEADERS = [
@@ -110,51 +117,445 @@ def _header_index_map(headers: List[str]) -> Dict[str, int]:
     return mp
 
 
+def _format_marker_path() -> str:
+    return str(os.getenv('SHEET_FORMAT_FILE', '') or 'state/sheet_format.json').strip()
+
+
+def _load_format_markers() -> Dict[str, str]:
+    path = _format_marker_path()
+    try:
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+            if isinstance(raw, dict):
+                return {str(k): str(v) for k, v in raw.items()}
+    except Exception:
+        pass
+    return {}
+
+
+def _save_format_markers(data: Dict[str, str]) -> None:
+    path = _format_marker_path()
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _payload_row(p: Dict, hdrs: List[str], hmap: Dict[str, int]) -> List[str]:
+    row = ['' for _ in range(len(hdrs))]
+    for k, v in p.items():
+        kk = _canon_key(k)
+        if kk in hmap:
+            val = str(v if v is not None else '')
+            # For date-related fields: enforce cell types via input value
+            # - If value is YYYY-MM (no day), force TEXT by prefixing an apostrophe
+            # - If value is YYYY-MM-DD, keep as-is so USER_ENTERED parses as a date
+            if kk in {'preorderstart', 'preorderend', 'releasedate', 'shippingdate'}:
+                try:
+                    if re.match(r'^\d{4}-\d{2}$', val):
+                        val = "'" + val
+                except Exception:
+                    pass
+            row[hmap[kk]] = val
+    return row
+
+
+# Columns left alone when an existing row is updated in place: they are
+# filled or edited downstream (GAS/WordPress publishing) after ingestion.
+PRESERVE_ON_UPDATE = {
+    'date', 'body', 'slug', 'category', 'keyword', 'affiliatelink', 'agerating',
+    'wppostid', 'wpposturl', 'needsreview', 'status',
+}
+
+
+def _appended_start_row(resp) -> int | None:
+    try:
+        rng = str(resp['updates']['updatedRange'])
+    except Exception:
+        return None
+    m = re.search(r'![A-Z]+(\d+)', rng)
+    return int(m.group(1)) if m else None
+
+
+class SheetWriter:
+    """Session-scoped handle on the product worksheet.
+
+    Authenticates and opens the worksheet once, and keeps the header row and
+    its index map for the rest of the process. Date column formats are only
+    (re)applied when the header row differs from the one recorded in
+    state/sheet_format.json (SHEET_FORMAT_FILE).
+
+    The SourceURL/SourceHash/ImageURL columns are read once (one batch range
+    read) into an index, so each payload is skipped (same hash), updated in
+    place (known URL, new hash) or appended. Legacy v1 hashes are compared via
+    hooks.sheet_hash_matches and, when they match, only the SourceHash cell is
+    rewritten with the v2 value.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self._client: gspread.Client | None = None
+        self._ws = None
+        self._headers: List[str] | None = None
+        self._hmap: Dict[str, int] = {}
+        self._index: Dict[str, Tuple[int | None, str, str]] | None = None
+
+    def worksheet(self):
+        with self._lock:
+            if self._ws is None:
+                if self._client is None:
+                    self._client = _get_client()
+                self._ws = _open_worksheet(self._client)
+            return self._ws
+
+    def headers(self) -> Tuple[List[str], Dict[str, int]]:
+        with self._lock:
+            if self._headers is None:
+                ws = self.worksheet()
+                # Prefer current sheet header row; initialize if empty
+                hdrs = ws.row_values(1)
+                if not hdrs:
+                    hdrs = list(SHEET_HEADERS)
+                    ws.resize(rows=max(ws.row_count, 2), cols=max(ws.col_count, len(hdrs)))
+                    ws.update('A1', [hdrs])
+                self._headers = hdrs
+                # Build case/space-insensitive header map
+                self._hmap = _header_index_map(hdrs)
+                self._ensure_formats(ws, hdrs)
+                try:
+                    print(f"[sheet] headers: {hdrs}")
+                    print(f"[sheet] idx(Date)={self._hmap.get('date','-')}, idx(SourceURL)={self._hmap.get('sourceurl','-')}")
+                except Exception:
+                    pass
+            return self._headers, self._hmap
+
+    def _ensure_formats(self, ws, hdrs: List[str]) -> None:
+        # The marker file lives in state/, which the workflow commits, so the
+        # spreadsheet id (a secret) is only stored hashed.
+        sheet = f"{os.environ.get('GOOGLE_SHEETS_ID', '').strip()}/{getattr(ws, 'title', '')}"
+        key = hashlib.sha256(sheet.encode('utf-8')).hexdigest()[:16]
+        digest = hashlib.sha256('\x1f'.join(hdrs).encode('utf-8')).hexdigest()
+        # Entries keyed by the raw id (older versions) are dropped on the next save
+        markers = {k: v for k, v in _load_format_markers().items() if re.fullmatch(r'[0-9a-f]{16}', k)}
+        if markers.get(key) == digest:
+            return
+        # Best-effort: enforce date display format for date columns
+        _ensure_date_column_formats(ws, hdrs)
+        markers[key] = digest
+        try:
+            _save_format_markers(markers)
+        except Exception as exc:
+            print(f"[sheet] failed to record header format marker: {exc}")
+
+    def index(self) -> Dict[str, Tuple[int | None, str, str]]:
+        """SourceURL -> (sheet row number, SourceHash, ImageURL) for rows already in the sheet.
+
+        ImageURL is only needed to check legacy v1 hashes, which covered the
+        mirrored image URLs.
+        """
+        with self._lock:
+            if self._index is None:
+                _, hmap = self.headers()
+                index: Dict[str, Tuple[int | None, str, str]] = {}
+                ui, hi, ii = hmap.get('sourceurl'), hmap.get('sourcehash'), hmap.get('imageurl')
+                if ui is not None:
+                    ranges = [f"{_col_a1(ui)}2:{_col_a1(ui)}"]
+                    if hi is not None:
+                        ranges.append(f"{_col_a1(hi)}2:{_col_a1(hi)}")
+                        if ii is not None:
+                            ranges.append(f"{_col_a1(ii)}2:{_col_a1(ii)}")
+                    cols = self.worksheet().batch_get(ranges)
+                    urls = list(cols[0]) if cols else []
+                    hashes = list(cols[1]) if len(cols) > 1 else []
+                    images = list(cols[2]) if len(cols) > 2 else []
+                    for offset, cell in enumerate(urls):
+                        url = str(cell[0]).strip() if cell else ''
+                        if not url:
+                            continue
+                        h = hashes[offset] if offset < len(hashes) else []
+                        im = images[offset] if offset < len(images) else []
+                        # Last occurrence wins when the sheet already holds duplicates
+                        index[url] = (offset + 2, str(h[0]).strip() if h else '', str(im[0]) if im else '')
+                self._index = index
+                print(f"[sheet] dedup index: {len(index)} SourceURL(s)")
+            return self._index
+
+    def reset(self) -> None:
+        """Drop cached handles (e.g. after the sheet was edited mid-run)."""
+        with self._lock:
+            self._ws = None
+            self._headers = None
+            self._hmap = {}
+            self._index = None
+
+    def _update_ranges(self, row_no: int, row: List[str], hdrs: List[str]) -> List[Dict]:
+        """A1 ranges for the row's cells outside PRESERVE_ON_UPDATE, merged into runs."""
+        out: List[Dict] = []
+        start = None
+        for i in range(len(hdrs) + 1):
+            writable = i < len(hdrs) and _canon_key(hdrs[i]) not in PRESERVE_ON_UPDATE
+            if writable and start is None:
+                start = i
+            elif not writable and start is not None:
+                out.append({
+                    'range': f"{_col_a1(start)}{row_no}:{_col_a1(i - 1)}{row_no}",
+                    'values': [row[start:i]],
+                })
+                start = None
+        return out
+
+    def write(self, payloads: List[Dict]) -> List[str]:
+        """Write payloads; returns 'append', 'update' or 'skip' for each one, in order."""
+        if not payloads:
+            return []
+        from .hooks import sheet_hash_matches
+        with self._lock:
+            hdrs, hmap = self.headers()
+            index = self.index()
+            outcomes: List[str] = []
+            appends: List[Tuple[str, List[str]]] = []
+            updates: List[Dict] = []
+            pending: Dict[str, int] = {}
+            for p in payloads:
+                url = str(p.get('SourceURL') or '').strip()
+                new_hash = str(p.get('SourceHash') or '').strip()
+                row = _payload_row(p, hdrs, hmap)
+                known = index.get(url) if url else None
+                if url in pending:
+                    # Same item twice in one batch: the later payload replaces the queued row
+                    appends[pending[url]] = (url, row)
+                    outcomes.append('update')
+                elif known and new_hash and sheet_hash_matches(known[1], p, known[2]):
+                    outcomes.append('skip')
+                    if known[1] != new_hash and known[0] is not None and 'sourcehash' in hmap:
+                        # Legacy v1 match: upgrade the stored hash, leave the row alone
+                        col = _col_a1(hmap['sourcehash'])
+                        updates.append({'range': f"{col}{known[0]}", 'values': [[new_hash]]})
+                        index[url] = (known[0], new_hash, known[2])
+                elif known and known[0] is not None:
+                    updates.extend(self._update_ranges(known[0], row, hdrs))
+                    index[url] = (known[0], new_hash, row[hmap['imageurl']] if 'imageurl' in hmap else '')
+                    outcomes.append('update')
+                else:
+                    if url:
+                        pending[url] = len(appends)
+                    appends.append((url, row))
+                    outcomes.append('append')
+                try:
+                    di = hmap.get('date')
+                    si = hmap.get('sourceurl')
+                    print(f"[sheet] {outcomes[-1]}: Date@{di}={row[di] if di is not None else ''} | SourceURL@{si}={row[si] if si is not None else ''}")
+                except Exception:
+                    pass
+            try:
+                ws = self.worksheet()
+                if updates:
+                    ws.batch_update(updates, raw=False, value_input_option='USER_ENTERED')
+                if appends:
+                    # Anchor appends to column A to avoid Google 'table range' auto-shifts
+                    resp = ws.append_rows([r for _, r in appends], value_input_option='USER_ENTERED', table_range='A1')
+                    first = _appended_start_row(resp)
+                    for offset, (url, row) in enumerate(appends):
+                        if url:
+                            h = row[hmap['sourcehash']] if 'sourcehash' in hmap else ''
+                            im = row[hmap['imageurl']] if 'imageurl' in hmap else ''
+                            index[url] = (first + offset if first else None, h, im)
+            except Exception:
+                # Re-read the worksheet, headers and index on the next call
+                self.reset()
+                raise
+            return outcomes
+
+    def append(self, payloads: List[Dict]) -> int:
+        """Write payloads and return how many rows were appended or updated."""
+        return sum(1 for o in self.write(payloads) if o != 'skip')
+
+
+_WRITER: SheetWriter | None = None
+_WRITER_LOCK = threading.Lock()
+
+
+def get_writer() -> SheetWriter:
+    global _WRITER
+    with _WRITER_LOCK:
+        if _WRITER is None:
+            _WRITER = SheetWriter()
+        return _WRITER
+
+
 def append_payloads(payloads: List[Dict]) -> int:
     if not payloads:
         return 0
-    client = _get_client()
-    ws = _open_worksheet(client)
-    # Prefer current sheet header row; initialize if empty
-    hdrs = ws.row_values(1)
-    if not hdrs:
-        hdrs = list(SHEET_HEADERS)
-        ws.resize(rows=max(ws.row_count, 2), cols=max(ws.col_count, len(hdrs)))
-        ws.update('A1', [hdrs])
-    # Build case/space-insensitive header map
-    hmap = _header_index_map(hdrs)
-    # Best-effort: enforce date display format for date columns
-    _ensure_date_column_formats(ws, hdrs)
+    return _with_backoff(lambda: get_writer().append(payloads), 'append')
+
+
+# ======================== retry / backoff ========================
+# Sheets API quota (429) and server errors are retried with exponential
+# backoff plus jitter, honoring Retry-After when Google sends one.
+# SHEETS_RETRIES (default 5), SHEETS_RETRY_BASE (seconds, default 2) and
+# SHEETS_RETRY_MAX (seconds, default 64) tune it.
+
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def _env_float(name: str, default: float) -> float:
     try:
-        print(f"[sheet] headers: {hdrs}")
-        print(f"[sheet] idx(Date)={hmap.get('date','-')}, idx(SourceURL)={hmap.get('sourceurl','-')}")
-    except Exception:
+        return float(os.environ.get(name, '') or default)
+    except ValueError:
+        return default
+
+
+def _error_status(exc: Exception) -> int | None:
+    resp = getattr(exc, 'response', None)
+    code = getattr(resp, 'status_code', None) or getattr(exc, 'code', None)
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_delay(exc: Exception, attempt: int) -> float | None:
+    """Seconds to wait before retrying `exc`, or None when it is not retryable."""
+    status = _error_status(exc)
+    transient = isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+    if status not in _RETRY_STATUS and not transient:
+        return None
+    cap = _env_float('SHEETS_RETRY_MAX', 64)
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    try:
+        retry_after = float(headers.get('Retry-After'))
+        return min(cap, max(0.0, retry_after))
+    except (TypeError, ValueError):
         pass
-    rows: List[List[str]] = []
-    for p in payloads:
-        row = ['' for _ in range(len(hdrs))]
-        for k, v in p.items():
-            kk = _canon_key(k)
-            if kk in hmap:
-                val = str(v if v is not None else '')
-                # For date-related fields: enforce cell types via input value
-                # - If value is YYYY-MM (no day), force TEXT by prefixing an apostrophe
-                # - If value is YYYY-MM-DD, keep as-is so USER_ENTERED parses as a date
-                if kk in {'preorderstart', 'preorderend', 'releasedate', 'shippingdate'}:
-                    try:
-                        if re.match(r'^\d{4}-\d{2}$', val):
-                            val = "'" + val
-                    except Exception:
-                        pass
-                row[hmap[kk]] = val
+    base = _env_float('SHEETS_RETRY_BASE', 2)
+    return min(cap, base * (2 ** attempt)) + random.uniform(0, base)
+
+
+def _with_backoff(fn, what: str):
+    retries = max(0, int(_env_float('SHEETS_RETRIES', 5)))
+    attempt = 0
+    while True:
         try:
-            di = hmap.get('date')
-            si = hmap.get('sourceurl')
-            print(f"[sheet] row preview: Date@{di}={row[di] if di is not None else ''} | SourceURL@{si}={row[si] if si is not None else ''}")
-        except Exception:
-            pass
-        rows.append(row)
-    # Anchor appends to column A to avoid Google 'table range' auto-shifts
-    ws.append_rows(rows, value_input_option='USER_ENTERED', table_range='A1')
-    return len(rows)
+            return fn()
+        except Exception as exc:
+            delay = _retry_delay(exc, attempt)
+            if delay is None or attempt >= retries:
+                raise
+            print(f"[sheet] {what} failed (status={_error_status(exc) or '-'}: {exc}); retry {attempt + 1}/{retries} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+# ======================== run-level write buffer ========================
+# During a monitor run every site's payloads are first persisted to the
+# state store's sheet_queue, then written by flush() in as few API calls as
+# possible (SHEETS_APPEND_CHUNK rows each, default 500) with per-site
+# accounting of what landed. Rows that still fail stay queued and are
+# replayed by the next run's flush; the dedup index makes replays
+# idempotent. Rows failing SHEETS_QUEUE_MAX_ATTEMPTS flushes (default 20)
+# are dropped with a log line.
+
+def _chunk_size() -> int:
+    try:
+        return max(1, int(os.environ.get('SHEETS_APPEND_CHUNK', '') or 500))
+    except ValueError:
+        return 500
+
+
+class RunBuffer:
+    def __init__(self, writer: SheetWriter, store: state_store.StateStore) -> None:
+        self._writer = writer
+        self._store = store
+        self._lock = threading.Lock()
+        self._ids: set[int] = set()
+
+    def add(self, site_id: str, payloads: List[Dict]) -> int:
+        ids = self._store.enqueue_sheet_rows(site_id, payloads)
+        with self._lock:
+            self._ids.update(ids)
+        return len(ids)
+
+    def pending(self) -> int:
+        return len(self._store.pending_sheet_rows())
+
+    def flush(self) -> Dict[str, Dict]:
+        """Write everything queued, including leftovers of earlier runs.
+
+        Returns {site_id: {'queued', 'replayed', 'wrote', 'skipped', 'error', 'payloads'}};
+        'payloads' holds the ones now in the sheet (written or already present).
+        """
+        rows = self._store.pending_sheet_rows()
+        max_attempts = max(1, int(_env_float('SHEETS_QUEUE_MAX_ATTEMPTS', 20)))
+        with self._lock:
+            current, self._ids = self._ids, set()
+        results: Dict[str, Dict] = {}
+        for qid, site_id, _, _ in rows:
+            r = results.setdefault(site_id, {'queued': 0, 'replayed': 0, 'wrote': 0, 'skipped': 0, 'error': '', 'payloads': []})
+            r['queued'] += 1
+            if qid not in current:
+                r['replayed'] += 1
+        size = _chunk_size()
+        error = ''
+        chunks = 0
+        for start in range(0, len(rows), size):
+            chunk = rows[start:start + size]
+            outcomes: List[str] = []
+            if not error:
+                try:
+                    outcomes = _with_backoff(lambda: self._writer.write([p for _, _, p, _ in chunk]), 'write')
+                    chunks += 1
+                except Exception as exc:
+                    # Later chunks are not attempted so rows keep their order
+                    error = str(exc) or exc.__class__.__name__
+            if error:
+                self._store.fail_sheet_rows([qid for qid, _, _, _ in chunk], error)
+                expired = [qid for qid, _, _, attempts in chunk if attempts + 1 >= max_attempts]
+                if expired:
+                    print(f"[sheet] dropping {len(expired)} queued row(s) after {max_attempts} failed attempt(s)")
+                    self._store.ack_sheet_rows(expired)
+                for _, site_id, _, _ in chunk:
+                    results[site_id]['error'] = error
+                continue
+            self._store.ack_sheet_rows([qid for qid, _, _, _ in chunk])
+            for pos, (_, site_id, p, _) in enumerate(chunk):
+                r = results[site_id]
+                if outcomes[pos] == 'skip':
+                    r['skipped'] += 1
+                else:
+                    r['wrote'] += 1
+                r['payloads'].append(p)
+        if rows:
+            wrote = sum(r['wrote'] for r in results.values())
+            skipped = sum(r['skipped'] for r in results.values())
+            replayed = sum(r['replayed'] for r in results.values())
+            print(f"[sheet] run commit: wrote {wrote}/{len(rows)} row(s) ({replayed} from earlier runs), {skipped} already present, "
+                  f"from {len(results)} site(s) in {chunks} call(s)"
+                  + (f"; error: {error} (rows kept in queue)" if error else ''))
+        return results
+
+
+_RUN_BUFFER: RunBuffer | None = None
+
+
+def start_run_buffer() -> RunBuffer:
+    global _RUN_BUFFER
+    with _WRITER_LOCK:
+        if _RUN_BUFFER is None:
+            _RUN_BUFFER = RunBuffer(get_writer(), state_store.get_store())
+        return _RUN_BUFFER
+
+
+def run_buffer() -> RunBuffer | None:
+    return _RUN_BUFFER
+
 
+def flush_run_buffer() -> Dict[str, Dict]:
+    """Flush and detach the run buffer; later appends go straight to the sheet."""
+    global _RUN_BUFFER
+    with _WRITER_LOCK:
+        buf, _RUN_BUFFER = _RUN_BUFFER, None
+    return buf.flush() if buf is not None else {}
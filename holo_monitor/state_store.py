@@ -0,0 +1,507 @@
+from __future__ import annotations
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, List
+
+# Embedded SQLite state store (WAL mode) replacing the per-site
+# state/*.json rewrites. All sites share one database file; per-site tables are
+# keyed by site_id so lookups for one site hit the primary-key index.
+#
+#   seen_ids   one row per (site, item): first/last seen, listing hash
+#   site_meta  per-site head anchor
+#   anchors    per-site top-K ids of the last listing walk, in page order
+#   backlog    per-site detail items carried over to the next run
+#   source_hashes  SourceURL -> SourceHash of the last payload written to the sheet
+#   sheet_queue    payloads waiting to be written to the sheet (write-behind)
+#   wp_media       source image URL -> body hash, HTTP validators and mirrored WordPress media URL
+#
+# The legacy JSON files stay readable: a site with no rows yet is imported
+# from its state_file on first use, and `python -m holo_monitor.state_store`
+# exports/imports JSON for inspection or rollback.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen_ids (
+    site_id      TEXT NOT NULL,
+    item_id      TEXT NOT NULL,
+    first_seen   REAL NOT NULL,
+    last_seen    REAL NOT NULL,
+    content_hash TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (site_id, item_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS seen_ids_last_seen ON seen_ids (site_id, last_seen);
+CREATE TABLE IF NOT EXISTS site_meta (
+    site_id    TEXT PRIMARY KEY,
+    head_id    TEXT NOT NULL DEFAULT '',
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS anchors (
+    site_id  TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    item_id  TEXT NOT NULL,
+    PRIMARY KEY (site_id, position)
+);
+CREATE TABLE IF NOT EXISTS source_hashes (
+    source_url  TEXT PRIMARY KEY,
+    source_hash TEXT NOT NULL,
+    updated_at  REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sheet_queue (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    site_id      TEXT NOT NULL,
+    payload_json TEXT NOT NULL,
+    enqueued_at  REAL NOT NULL,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    last_error   TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS wp_media (
+    source_url     TEXT PRIMARY KEY,
+    content_hash   TEXT NOT NULL DEFAULT '',
+    media_url      TEXT NOT NULL DEFAULT '',
+    updated_at     REAL NOT NULL,
+    etag           TEXT NOT NULL DEFAULT '',
+    last_modified  TEXT NOT NULL DEFAULT '',
+    content_length INTEGER NOT NULL DEFAULT 0,
+    checked_at     REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS wp_media_hash ON wp_media (content_hash);
+CREATE TABLE IF NOT EXISTS backlog (
+    site_id   TEXT NOT NULL,
+    position  INTEGER NOT NULL,
+    item_json TEXT NOT NULL,
+    PRIMARY KEY (site_id, position)
+);
+"""
+
+# Columns added after a table was first shipped: (table, column, definition).
+# Applied with ALTER TABLE on databases created by older versions.
+MIGRATIONS = (
+    ('wp_media', 'etag', "TEXT NOT NULL DEFAULT ''"),
+    ('wp_media', 'last_modified', "TEXT NOT NULL DEFAULT ''"),
+    ('wp_media', 'content_length', 'INTEGER NOT NULL DEFAULT 0'),
+    ('wp_media', 'checked_at', 'REAL NOT NULL DEFAULT 0'),
+)
+
+
+def default_db_path() -> str:
+    return str(os.getenv('STATE_DB', '') or os.path.join('state', 'monitor.sqlite3')).strip()
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    """How long seen ids are remembered per site (0 disables a limit).
+
+    Ids not seen for max_age_days are dropped, then only the max_ids most
+    recently seen are kept, so the set loaded each run stays bounded while
+    items that briefly fall off the listing are not re-detected as new.
+    """
+    max_age_days: float = 180.0
+    max_ids: int = 5000
+
+
+def _env_number(name: str, default: float) -> float:
+    try:
+        return float(str(os.getenv(name, '')).strip() or default)
+    except ValueError:
+        return default
+
+
+def retention_for(site: Dict[str, Any]) -> RetentionPolicy:
+    """Site `state_retention` from sites.yaml over STATE_MAX_AGE_DAYS / STATE_MAX_IDS defaults."""
+    conf = site.get('state_retention') or {}
+    if not isinstance(conf, dict):
+        conf = {}
+    age = conf.get('max_age_days', _env_number('STATE_MAX_AGE_DAYS', 180))
+    count = conf.get('max_ids', _env_number('STATE_MAX_IDS', 5000))
+    try:
+        return RetentionPolicy(max(0.0, float(age)), max(0, int(count)))
+    except (TypeError, ValueError):
+        return RetentionPolicy()
+
+
+# ======================== legacy JSON files ========================
+
+def read_json_state(path: str) -> Dict[str, Any]:
+    """Read a legacy state/*.json file as {'ids', 'head_id', 'anchors', 'backlog'}."""
+    out: Dict[str, Any] = {'ids': [], 'head_id': '', 'anchors': [], 'backlog': []}
+    if not path or not os.path.exists(path):
+        return out
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except Exception:
+        return out
+    if isinstance(data, dict):
+        out['ids'] = [str(x) for x in (data.get('ids', []) or data.get('gcodes', []) or []) if str(x).strip()]
+        out['head_id'] = str(data.get('head_id', '') or '').strip()
+        out['anchors'] = [str(x) for x in (data.get('anchors') or []) if str(x).strip()]
+        out['backlog'] = [it for it in (data.get('backlog') or []) if isinstance(it, dict)]
+    return out
+
+
+def write_json_state(path: str, data: Dict[str, Any]) -> None:
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    out: Dict[str, Any] = {'ids': sorted(data.get('ids') or []), 'head_id': data.get('head_id') or ''}
+    if data.get('anchors'):
+        out['anchors'] = list(data['anchors'])
+    if data.get('backlog'):
+        out['backlog'] = list(data['backlog'])
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(out, f, ensure_ascii=False, indent=2)
+
+
+# ======================== store ========================
+
+class StateStore:
+    def __init__(self, path: str):
+        self.path = path
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        # One connection shared by the site worker threads, serialized by a lock.
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._lock = threading.RLock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+            self._migrate()
+
+    def _migrate(self) -> None:
+        for table, column, decl in MIGRATIONS:
+            cols = {r[1] for r in self._conn.execute(f'PRAGMA table_info({table})')}
+            if column not in cols:
+                self._conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+    # ---- helpers ----
+    @contextmanager
+    def _tx(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def _query(self, sql: str, params: Iterable[Any] = ()) -> List[tuple]:
+        with self._lock:
+            return list(self._conn.execute(sql, tuple(params)))
+
+    # ---- reads ----
+    def has_site(self, site_id: str) -> bool:
+        return bool(self._query('SELECT 1 FROM site_meta WHERE site_id = ?', (site_id,)))
+
+    def load_ids(self, site_id: str) -> set[str]:
+        return {r[0] for r in self._query('SELECT item_id FROM seen_ids WHERE site_id = ?', (site_id,))}
+
+    def load_fingerprints(self, site_id: str) -> Dict[str, str]:
+        """Seen ids mapped to their stored listing fingerprint ('' if none yet)."""
+        rows = self._query('SELECT item_id, content_hash FROM seen_ids WHERE site_id = ?', (site_id,))
+        return {r[0]: str(r[1] or '') for r in rows}
+
+    def is_seen(self, site_id: str, item_id: str) -> bool:
+        return bool(self._query('SELECT 1 FROM seen_ids WHERE site_id = ? AND item_id = ?', (site_id, item_id)))
+
+    def head_id(self, site_id: str) -> str:
+        rows = self._query('SELECT head_id FROM site_meta WHERE site_id = ?', (site_id,))
+        return str(rows[0][0] or '') if rows else ''
+
+    def anchors(self, site_id: str) -> List[str]:
+        """Top ids from the previous walk, falling back to the single head id."""
+        rows = self._query('SELECT item_id FROM anchors WHERE site_id = ? ORDER BY position', (site_id,))
+        if rows:
+            return [str(r[0]) for r in rows]
+        head = self.head_id(site_id)
+        return [head] if head else []
+
+    def load_backlog(self, site_id: str) -> List[Dict[str, Any]]:
+        rows = self._query('SELECT item_json FROM backlog WHERE site_id = ? ORDER BY position', (site_id,))
+        out: List[Dict[str, Any]] = []
+        for (raw,) in rows:
+            try:
+                item = json.loads(raw)
+            except Exception:
+                continue
+            if isinstance(item, dict):
+                out.append(item)
+        return out
+
+    def source_hash(self, source_url: str) -> str:
+        rows = self._query('SELECT source_hash FROM source_hashes WHERE source_url = ?', (source_url,))
+        return str(rows[0][0] or '') if rows else ''
+
+    # ---- writes ----
+    def record_source_hashes(self, pairs: Iterable[tuple], now: float | None = None) -> None:
+        """Remember (SourceURL, SourceHash) pairs after a successful sheet write."""
+        ts = time.time() if now is None else now
+        rows = [(str(u), str(h), ts) for u, h in pairs if u and h]
+        with self._tx() as c:
+            c.executemany(
+                'INSERT INTO source_hashes (source_url, source_hash, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(source_url) DO UPDATE SET source_hash = excluded.source_hash, updated_at = excluded.updated_at',
+                rows,
+            )
+
+    # ---- WordPress media mirror ----
+    def wp_media_for_url(self, source_url: str) -> Dict[str, Any] | None:
+        rows = self._query(
+            'SELECT content_hash, media_url, etag, last_modified, content_length, checked_at, updated_at '
+            'FROM wp_media WHERE source_url = ?',
+            (source_url,),
+        )
+        if not rows or not rows[0][1]:
+            return None
+        h, media_url, etag, last_modified, length, checked_at, updated_at = rows[0]
+        return {
+            'content_hash': str(h or ''),
+            'media_url': str(media_url),
+            'etag': str(etag or ''),
+            'last_modified': str(last_modified or ''),
+            'content_length': int(length or 0),
+            'checked_at': float(checked_at or updated_at or 0),
+        }
+
+    def wp_media_for_hash(self, content_hash: str) -> str:
+        if not content_hash:
+            return ''
+        rows = self._query(
+            "SELECT media_url FROM wp_media WHERE content_hash = ? AND media_url != '' ORDER BY updated_at DESC LIMIT 1",
+            (content_hash,),
+        )
+        return str(rows[0][0]) if rows else ''
+
+    def record_wp_media(self, source_url: str, content_hash: str, media_url: str,
+                        validators: Dict[str, Any] | None = None, now: float | None = None) -> None:
+        """Store the mirror result for a source URL with its ETag/Last-Modified/Content-Length."""
+        ts = time.time() if now is None else now
+        v = validators or {}
+        with self._tx() as c:
+            c.execute(
+                'INSERT INTO wp_media (source_url, content_hash, media_url, updated_at, etag, last_modified, '
+                'content_length, checked_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(source_url) DO UPDATE SET content_hash = excluded.content_hash, '
+                'media_url = excluded.media_url, updated_at = excluded.updated_at, etag = excluded.etag, '
+                'last_modified = excluded.last_modified, content_length = excluded.content_length, '
+                'checked_at = excluded.checked_at',
+                (source_url, content_hash or '', media_url or '', ts, str(v.get('etag') or ''),
+                 str(v.get('last_modified') or ''), int(v.get('content_length') or 0), ts),
+            )
+
+    def touch_wp_media(self, source_url: str, now: float | None = None) -> None:
+        """Mark a mirrored source image as re-validated (unchanged upstream)."""
+        ts = time.time() if now is None else now
+        with self._tx() as c:
+            c.execute('UPDATE wp_media SET checked_at = ? WHERE source_url = ?', (ts, source_url))
+
+    # ---- sheet write-behind queue ----
+    def enqueue_sheet_rows(self, site_id: str, payloads: List[Dict[str, Any]], now: float | None = None) -> List[int]:
+        """Persist payloads before they are sent to the sheet; returns their queue ids."""
+        ts = time.time() if now is None else now
+        ids: List[int] = []
+        with self._tx() as c:
+            for p in payloads:
+                cur = c.execute(
+                    'INSERT INTO sheet_queue (site_id, payload_json, enqueued_at) VALUES (?, ?, ?)',
+                    (site_id, json.dumps(p, ensure_ascii=False, default=str), ts),
+                )
+                ids.append(int(cur.lastrowid))
+        return ids
+
+    def pending_sheet_rows(self) -> List[tuple]:
+        """Queued rows in enqueue order as (id, site_id, payload, attempts)."""
+        out: List[tuple] = []
+        for qid, site_id, raw, attempts in self._query(
+            'SELECT id, site_id, payload_json, attempts FROM sheet_queue ORDER BY id'
+        ):
+            try:
+                payload = json.loads(raw)
+            except Exception:
+                payload = None
+            if isinstance(payload, dict):
+                out.append((int(qid), str(site_id), payload, int(attempts)))
+        return out
+
+    def ack_sheet_rows(self, ids: Iterable[int]) -> None:
+        with self._tx() as c:
+            c.executemany('DELETE FROM sheet_queue WHERE id = ?', [(int(i),) for i in ids])
+
+    def fail_sheet_rows(self, ids: Iterable[int], error: str) -> None:
+        with self._tx() as c:
+            c.executemany(
+                'UPDATE sheet_queue SET attempts = attempts + 1, last_error = ? WHERE id = ?',
+                [(str(error)[:500], int(i)) for i in ids],
+            )
+
+    def commit_run(self, site_id: str, seen_ids: Iterable[str], head_id: str,
+                   backlog: List[Dict[str, Any]] | None = None, now: float | None = None,
+                   retention: RetentionPolicy | None = None, anchors: List[str] | None = None,
+                   fingerprints: Dict[str, str] | None = None) -> int:
+        """Record one run for a site in a single transaction.
+
+        Seen ids are upserted (first_seen kept, last_seen bumped, listing
+        fingerprint replaced when one is given); the head anchor, anchor
+        list (when given) and backlog are replaced. With a
+        retention policy, expired and least recently seen ids are pruned
+        (anchors are always kept); returns the pruned count.
+        """
+        ts = time.time() if now is None else now
+        with self._tx() as c:
+            self._write_run(c, site_id, seen_ids, head_id, backlog, ts, anchors, fingerprints)
+            return self._prune(c, site_id, head_id, retention, ts) if retention else 0
+
+    @staticmethod
+    def _prune(c: sqlite3.Connection, site_id: str, head_id: str, policy: RetentionPolicy, ts: float) -> int:
+        keep = ' AND item_id != ? AND item_id NOT IN (SELECT item_id FROM anchors WHERE site_id = ?)'
+        removed = 0
+        if policy.max_age_days > 0:
+            cutoff = ts - policy.max_age_days * 86400
+            removed += c.execute(
+                'DELETE FROM seen_ids WHERE site_id = ? AND last_seen < ?' + keep,
+                (site_id, cutoff, head_id or '', site_id),
+            ).rowcount
+        if policy.max_ids > 0:
+            removed += c.execute(
+                'DELETE FROM seen_ids WHERE site_id = ?' + keep + ' AND item_id NOT IN ('
+                ' SELECT item_id FROM seen_ids WHERE site_id = ? ORDER BY last_seen DESC, first_seen DESC LIMIT ?)',
+                (site_id, head_id or '', site_id, site_id, policy.max_ids),
+            ).rowcount
+        return max(0, removed)
+
+    @staticmethod
+    def _write_run(c: sqlite3.Connection, site_id: str, seen_ids: Iterable[str], head_id: str,
+                   backlog: List[Dict[str, Any]] | None, ts: float, anchors: List[str] | None = None,
+                   fingerprints: Dict[str, str] | None = None) -> None:
+        fps = fingerprints or {}
+        rows = [(site_id, str(i), ts, ts, fps.get(str(i), '')) for i in seen_ids if str(i).strip()]
+        c.executemany(
+            'INSERT INTO seen_ids (site_id, item_id, first_seen, last_seen, content_hash) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(site_id, item_id) DO UPDATE SET last_seen = excluded.last_seen, '
+            "content_hash = CASE WHEN excluded.content_hash != '' THEN excluded.content_hash ELSE seen_ids.content_hash END",
+            rows,
+        )
+        c.execute(
+            'INSERT INTO site_meta (site_id, head_id, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(site_id) DO UPDATE SET head_id = excluded.head_id, updated_at = excluded.updated_at',
+            (site_id, head_id or '', ts),
+        )
+        if anchors is not None:
+            c.execute('DELETE FROM anchors WHERE site_id = ?', (site_id,))
+            c.executemany(
+                'INSERT INTO anchors (site_id, position, item_id) VALUES (?, ?, ?)',
+                [(site_id, i, str(a)) for i, a in enumerate(anchors) if str(a).strip()],
+            )
+        c.execute('DELETE FROM backlog WHERE site_id = ?', (site_id,))
+        c.executemany(
+            'INSERT INTO backlog (site_id, position, item_json) VALUES (?, ?, ?)',
+            [(site_id, i, json.dumps(it, ensure_ascii=False)) for i, it in enumerate(backlog or [])],
+        )
+
+    # ---- JSON interop ----
+    def import_site(self, site_id: str, data: Dict[str, Any], now: float | None = None) -> int:
+        """Replace a site's state with legacy JSON data; returns the id count."""
+        ts = time.time() if now is None else now
+        ids = list(data.get('ids') or [])
+        with self._tx() as c:
+            for table in ('seen_ids', 'site_meta', 'anchors', 'backlog'):
+                c.execute(f'DELETE FROM {table} WHERE site_id = ?', (site_id,))
+            anchors = [str(a) for a in (data.get('anchors') or []) if str(a).strip()]
+            self._write_run(c, site_id, ids, str(data.get('head_id') or ''), list(data.get('backlog') or []), ts, anchors)
+        return len(ids)
+
+    def export_site(self, site_id: str) -> Dict[str, Any]:
+        return {
+            'ids': sorted(self.load_ids(site_id)),
+            'head_id': self.head_id(site_id),
+            'anchors': self.anchors(site_id),
+            'backlog': self.load_backlog(site_id),
+        }
+
+    def ensure_migrated(self, site_id: str, json_path: str | None) -> bool:
+        """Import `json_path` for a site the database has never seen. Returns True if imported."""
+        if self.has_site(site_id) or not json_path or not os.path.exists(json_path):
+            return False
+        self.import_site(site_id, read_json_state(json_path))
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            try:
+                self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            except Exception:
+                pass
+            self._conn.close()
+
+
+_STORE: StateStore | None = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_store() -> StateStore:
+    global _STORE
+    if _STORE is None:
+        with _STORE_LOCK:
+            if _STORE is None:
+                _STORE = StateStore(default_db_path())
+    return _STORE
+
+
+def close_store() -> None:
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is not None:
+            _STORE.close()
+            _STORE = None
+
+
+# ======================== CLI ========================
+# python -m holo_monitor.state_store export [--site ID ...]
+# python -m holo_monitor.state_store import [--site ID ...]
+#
+# Sites and their JSON paths come from sites.yaml (state_file); export writes
+# the database contents back to those files, import replaces the database
+# rows from them.
+
+def _main(argv: List[str]) -> int:
+    import argparse
+    ap = argparse.ArgumentParser(prog='python -m holo_monitor.state_store', description='Export/import site state between SQLite and state/*.json.')
+    ap.add_argument('command', choices=('export', 'import'))
+    ap.add_argument('--site', action='append', help='limit to these site ids (repeatable)')
+    ap.add_argument('--db', help='database path (default: STATE_DB or state/monitor.sqlite3)')
+    args = ap.parse_args(argv)
+
+    from .runner import load_yaml
+    cfg_path = os.environ.get('SITES_YAML', os.path.join(os.path.dirname(__file__), 'sites.yaml'))
+    sites = (load_yaml(cfg_path).get('sites') or []) if os.path.exists(cfg_path) else []
+    if args.site:
+        sites = [s for s in sites if str(s.get('id')) in set(args.site)]
+    store = StateStore(args.db or default_db_path())
+    try:
+        for site in sites:
+            site_id = str(site.get('id', 'site') or 'site')
+            path = site.get('state_file', f'state/{site_id}.json')
+            if args.command == 'export':
+                data = store.export_site(site_id)
+                write_json_state(path, data)
+                print(f"[state] exported {site_id}: {len(data['ids'])} id(s) -> {path}", flush=True)
+            else:
+                if not os.path.exists(path):
+                    print(f"[state] {site_id}: {path} not found; skipped", flush=True)
+                    continue
+                n = store.import_site(site_id, read_json_state(path))
+                print(f"[state] imported {site_id}: {n} id(s) <- {path}", flush=True)
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,346 @@
+from __future__ import annotations
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import IO, Any, Dict, List, Tuple
+from urllib.parse import urlparse, parse_qs, quote
+
+from . import http_cache, state_store
+from .http_client import NotModified, get_session
+from .parallel import submit
+
+# Mirrors product images into the WordPress media library.
+#
+# Uploads are remembered in the state store (wp_media table) by source URL
+# and by sha256 of the image bytes, so a URL is uploaded once ever and
+# identical images served from different shops/URLs share one media entry.
+# The referer is the detail page the caller has just fetched on the shared
+# session, so its cookies are already there and it is not fetched again.
+# A gallery is mirrored on a pool of WP_MIRROR_WORKERS threads (default 4),
+# and downloads/uploads across all galleries and threads share one
+# semaphore of the same size, so concurrent hooks can't multiply it. Any
+# failure falls back to the source URL.
+#
+# Images are streamed: the download is read in chunks into a spooled temp
+# file (kept in memory up to WP_MIRROR_SPOOL_KB, default 1024, then on disk)
+# while being hashed, and uploaded as a raw request body with a
+# Content-Disposition filename instead of a multipart form built in memory.
+# Anything larger than WP_MIRROR_MAX_MB (default 20) is not mirrored.
+#
+# Known source URLs are trusted for WP_MIRROR_RECHECK_HOURS (default 24);
+# after that they are re-validated with a conditional GET (stored ETag /
+# Last-Modified) or, without validators, a HEAD compared against the
+# stored Content-Length, and only re-downloaded when those differ. Uploaded
+# files are named "<sha256 prefix>-<name>" so, before uploading, the WP
+# media library can be searched for an existing copy of the same bytes.
+
+HASH_PREFIX_LEN = 16
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36'
+
+_HASH_LOCKS: Dict[str, threading.Lock] = {}
+_HASH_LOCKS_GUARD = threading.Lock()
+_SLOTS: threading.BoundedSemaphore | None = None
+
+
+def _env(name: str) -> str:
+    return str(os.getenv(name, '')).strip()
+
+
+def wp_config() -> Tuple[str, Tuple[str, str]] | None:
+    site = _env('WP_SITE_URL')
+    user = _env('WP_USER')
+    app = _env('WP_APP_PASSWORD')
+    if not (site and user and app):
+        return None
+    return site.rstrip('/'), (user, app)
+
+
+def _workers() -> int:
+    try:
+        return max(1, int(_env('WP_MIRROR_WORKERS') or 4))
+    except ValueError:
+        return 4
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(float(_env(name) or default))
+    except ValueError:
+        return default
+
+
+def _max_bytes() -> int:
+    return max(1, _env_int('WP_MIRROR_MAX_MB', 20)) * 1024 * 1024
+
+
+def _spool_bytes() -> int:
+    return max(0, _env_int('WP_MIRROR_SPOOL_KB', 1024)) * 1024
+
+
+def _recheck_seconds() -> float:
+    try:
+        return float(_env('WP_MIRROR_RECHECK_HOURS') or 24) * 3600
+    except ValueError:
+        return 24 * 3600.0
+
+
+def _validators(headers: Any, size: int) -> Dict[str, Any]:
+    return {
+        'etag': headers.get('ETag') or '',
+        'last_modified': headers.get('Last-Modified') or '',
+        'content_length': size,
+    }
+
+
+def _slots() -> threading.BoundedSemaphore:
+    """Process-wide bound on in-flight downloads/uploads (WP_MIRROR_WORKERS)."""
+    global _SLOTS
+    with _HASH_LOCKS_GUARD:
+        if _SLOTS is None:
+            _SLOTS = threading.BoundedSemaphore(_workers())
+        return _SLOTS
+
+
+def _hash_lock(digest: str) -> threading.Lock:
+    with _HASH_LOCKS_GUARD:
+        lock = _HASH_LOCKS.get(digest)
+        if lock is None:
+            lock = _HASH_LOCKS[digest] = threading.Lock()
+        return lock
+
+
+def _guess_filename(url: str, content_type: str | None) -> str:
+    try:
+        parsed = urlparse(url)
+        path = parsed.path or 'image'
+    except Exception:
+        path = 'image'
+    name = (path.rsplit('/', 1)[-1] or 'image').split('?', 1)[0].split('#', 1)[0]
+    # animate等のリサイズPHP形式 (?image=filename.jpg) から元のファイル名を復元
+    try:
+        if (not name or name.endswith('.php')) and parsed and parsed.query:
+            q = parse_qs(parsed.query)
+            img_param = q.get('image', [])
+            if img_param:
+                candidate = str(img_param[0]).split('/')[-1]
+                if candidate:
+                    name = candidate
+    except Exception:
+        pass
+    if not re.search(r"\.[A-Za-z0-9]{3,4}$", name or '') and content_type:
+        mapping = {
+            'image/jpeg': '.jpg',
+            'image/jpg': '.jpg',
+            'image/png': '.png',
+            'image/webp': '.webp',
+            'image/gif': '.gif',
+        }
+        ext = mapping.get(content_type.lower())
+        if ext and not name.endswith(ext):
+            name = (name or 'image') + ext
+    return name or 'image.jpg'
+
+
+def _download(site: str, image_url: str, referer: str,
+              known: Dict[str, Any] | None = None) -> Tuple[IO[bytes], int, str, str, Dict[str, Any]] | None:
+    """Stream an image into a spooled file; returns (file, size, sha256, content type, validators).
+
+    A fresh disk-cache entry is used instead of the network when present.
+    With `known` (a previous mirror of this URL) the request is conditional
+    and NotModified is raised when the source is unchanged.
+    """
+    cached = http_cache.get(image_url)
+    if cached is not None:
+        if len(cached.content) > _max_bytes():
+            return None
+        spool = tempfile.SpooledTemporaryFile(max_size=_spool_bytes())
+        spool.write(cached.content)
+        spool.seek(0)
+        ct = (cached.headers.get('Content-Type') or '').split(';')[0].strip()
+        return (spool, len(cached.content), hashlib.sha256(cached.content).hexdigest(), ct,
+                _validators(cached.headers, len(cached.content)))
+    headers = {
+        'User-Agent': USER_AGENT,
+        'Accept': '*/*',
+        'Accept-Language': 'ja-JP,ja;q=0.9,en-US;q=0.8,en;q=0.7',
+        'Referer': referer or (site + '/'),
+    }
+    session = get_session()
+    if known:
+        if known.get('etag'):
+            headers['If-None-Match'] = known['etag']
+        if known.get('last_modified'):
+            headers['If-Modified-Since'] = known['last_modified']
+        if not (known.get('etag') or known.get('last_modified')) and known.get('content_length'):
+            try:
+                head = session.head(image_url, headers=headers, timeout=12, allow_redirects=True)
+                if head.status_code == 200 and str(head.headers.get('Content-Length') or '') == str(known['content_length']):
+                    raise NotModified(image_url, 'same Content-Length')
+            except NotModified:
+                raise
+            except Exception:
+                pass
+    limit = _max_bytes()
+    with closing(session.get(image_url, headers=headers, timeout=20, allow_redirects=True, stream=True)) as r:
+        if r.status_code == 304 and known:
+            raise NotModified(image_url, '304')
+        if not (200 <= r.status_code < 300):
+            return None
+        try:
+            declared = int(r.headers.get('Content-Length') or 0)
+        except ValueError:
+            declared = 0
+        if declared > limit:
+            print(f"[wp] skip {image_url}: {declared} bytes exceeds WP_MIRROR_MAX_MB", flush=True)
+            return None
+        spool = tempfile.SpooledTemporaryFile(max_size=_spool_bytes())
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in r.iter_content(64 * 1024):
+            size += len(chunk)
+            if size > limit:
+                spool.close()
+                print(f"[wp] skip {image_url}: body exceeds WP_MIRROR_MAX_MB", flush=True)
+                return None
+            digest.update(chunk)
+            spool.write(chunk)
+        ct = (r.headers.get('Content-Type') or '').split(';')[0].strip()
+        spool.seek(0)
+        # Only images that fit in the in-memory spool go to the disk cache
+        if size <= _spool_bytes():
+            http_cache.put(image_url, r.status_code, r.headers, spool.read())
+            spool.seek(0)
+        validators = _validators(r.headers, size)
+    return spool, size, digest.hexdigest(), ct, validators
+
+
+def _find_wp_media(site: str, auth: Tuple[str, str], digest: str) -> str:
+    """Look for an earlier upload of the same bytes by its hash-prefixed filename."""
+    prefix = digest[:HASH_PREFIX_LEN]
+    try:
+        r = get_session().get(site + '/wp-json/wp/v2/media',
+                              params={'search': prefix, 'per_page': 10, '_fields': 'id,source_url'},
+                              headers={'User-Agent': USER_AGENT}, auth=auth, timeout=20)
+        if r.status_code != 200:
+            return ''
+        for item in r.json() or []:
+            src = str((item or {}).get('source_url') or '')
+            if prefix in src.rsplit('/', 1)[-1]:
+                return src
+    except Exception:
+        pass
+    return ''
+
+
+class _UploadBody:
+    """Read-only view of a spooled image for a raw upload body.
+
+    requests sizes file objects via fileno(), which makes a
+    SpooledTemporaryFile roll over to disk; this exposes only read(),
+    iteration and a length, so small images stay in memory.
+    """
+
+    def __init__(self, f: IO[bytes], size: int):
+        self._f = f
+        self._size = size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def read(self, n: int = -1) -> bytes:
+        return self._f.read(n)
+
+    def __iter__(self):
+        while True:
+            chunk = self._f.read(64 * 1024)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _upload(site: str, auth: Tuple[str, str], image_url: str, body: IO[bytes], size: int, ct: str,
+            digest: str) -> str | None:
+    filename = f"{digest[:HASH_PREFIX_LEN]}-{_guess_filename(image_url, ct)}"
+    # Content-Type が無い/汎用の場合は拡張子から推測
+    if not ct or ct.lower() == 'application/octet-stream':
+        guessed, _ = mimetypes.guess_type(filename)
+        ct = guessed or 'image/jpeg'
+    headers = {
+        'User-Agent': USER_AGENT,
+        'Content-Type': ct,
+        'Content-Disposition': f'attachment; filename="{quote(filename)}"',
+        'Content-Length': str(size),
+    }
+    # Raw-body upload: requests streams the file object instead of building a multipart body
+    up = get_session().post(site + '/wp-json/wp/v2/media', headers=headers, data=_UploadBody(body, size),
+                            auth=auth, timeout=60)
+    if not (200 <= up.status_code < 300):
+        return None
+    try:
+        data = up.json()
+    except Exception:
+        return None
+    src = data.get('source_url') or (data.get('guid') or {}).get('rendered')
+    return str(src) if src else None
+
+
+def mirror_image(image_url: str, referer: str = '') -> str | None:
+    """WordPress media URL for `image_url`, uploading it if needed. None on failure."""
+    conf = wp_config()
+    if conf is None:
+        return None
+    site, auth = conf
+    # 既にWP配下のURLならそのまま返す
+    if image_url.startswith(site + '/'):
+        return image_url
+    store = state_store.get_store()
+    try:
+        known = store.wp_media_for_url(image_url)
+        if known and time.time() - known['checked_at'] < _recheck_seconds():
+            return known['media_url']
+        # Held across download and upload so the bytes in flight stay bounded
+        with _slots():
+            try:
+                fetched = _download(site, image_url, referer, known)
+            except NotModified:
+                store.touch_wp_media(image_url)
+                return known['media_url'] if known else None
+            if fetched is None:
+                return known['media_url'] if known else None
+            body, size, digest, ct, validators = fetched
+            with closing(body), _hash_lock(digest):
+                if known and known['content_hash'] == digest:
+                    media_url = known['media_url']
+                else:
+                    media_url = store.wp_media_for_hash(digest) or _find_wp_media(site, auth, digest)
+                    if media_url:
+                        print(f"[wp] reuse media for identical image: {image_url}", flush=True)
+                    else:
+                        media_url = _upload(site, auth, image_url, body, size, ct, digest) or ''
+                if media_url:
+                    store.record_wp_media(image_url, digest, media_url, validators)
+        return media_url or None
+    except Exception as exc:
+        print(f"[wp] mirror failed for {image_url}: {exc}", flush=True)
+        return None
+
+
+def mirror_images(urls: List[str], referer: str = '') -> List[str]:
+    """Mirror a gallery; returns WP URLs in input order (source URL where mirroring failed)."""
+    if wp_config() is None or not urls:
+        return list(urls)
+    unique = list(dict.fromkeys(urls))
+    workers = min(_workers(), len(unique))
+    if workers <= 1:
+        mirrored = {u: mirror_image(u, referer) for u in unique}
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='wp-mirror') as pool:
+            futures = {u: submit(pool, mirror_image, u, referer) for u in unique}
+            mirrored = {u: f.result() for u, f in futures.items()}
+    return [mirrored.get(u) or u for u in urls]